@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+
+
+def get_scene_key(LF):
+    """
+    Content hash of a light field
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    returns: str
+    """
+    LF = np.ascontiguousarray(LF)
+    digest = hashlib.sha1(str(LF.shape).encode())
+    digest.update(LF.data)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content-addressed storage of pipeline stage outputs.
+    A stage key hashes the stage name, the keys of its upstream artifacts and the
+    config values it depends on, so changing a downstream parameter reuses
+    everything computed before it.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, stage, upstream=(), config=None):
+        payload = json.dumps(
+            {"stage": stage, "upstream": list(upstream), "config": config or {}},
+            sort_keys=True,
+        )
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def path(self, stage, key):
+        return f"{self.folder}/{stage}-{key}.pt"
+
+    def load(self, stage, key):
+        path = self.path(stage, key)
+        if not os.path.exists(path):
+            return None
+        print(f"reusing {stage} artifact {key[:8]}")
+        return torch.load(path)
+
+    def save(self, stage, key, value):
+        path = self.path(stage, key)
+        torch.save(value, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)  # a killed process leaves no partial artifact
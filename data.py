@@ -3,13 +3,32 @@ from PIL import Image
 import os
 import math
 import h5py
-from plenpy.lightfields import LightField
-from utils import visualize_segmentation_mask
+
+
+def get_angular_slice(size, window=None):
+    """
+    Centered window of subviews along one angular axis
+    size: int, number of subviews
+    window: int, number of subviews to keep, None for all
+    returns: slice
+    """
+    if window is None or window >= size:
+        return slice(None)
+    start = size // 2 - window // 2
+    return slice(start, start + window)
 
 
 class HCIOldDataset:
-    def __init__(self, data_path="HCI_dataset_old"):
+    def __init__(
+        self, data_path="HCI_dataset_old", angular_window=None, spatial_downscale=1
+    ):
+        """
+        angular_window: int, read only the central window x window subviews
+        spatial_downscale: int, read every n-th pixel of each subview
+        """
         self.data_path = data_path
+        self.angular_window = angular_window
+        self.spatial_downscale = spatial_downscale
         self.scene_to_path = {}
         self.scenes = [
             "horses",
@@ -20,30 +39,38 @@ class HCIOldDataset:
         for scene in self.scenes:
             self.scene_to_path[scene] = f"{data_path}/{scene}"
 
-    def get_scene(self, name):
-        scene = h5py.File(f"{self.scene_to_path[name]}/lf.h5", "r")
-        LF = np.array(scene["LF"])
+    def get_window(self, dataset):
+        """
+        Hyperslab of the requested subviews and pixels of an [s, t, u, v, ...] dataset
+        """
+        s_size, t_size = dataset.shape[:2]
+        return (
+            get_angular_slice(s_size, self.angular_window),
+            get_angular_slice(t_size, self.angular_window),
+            slice(None, None, self.spatial_downscale),
+            slice(None, None, self.spatial_downscale),
+        )
+
+    def get_scene(self, scene):
+        LF = scene["LF"][self.get_window(scene["LF"]) + (slice(0, 3),)]
         LF = np.flip(LF, axis=0)
         return LF
 
     def get_labels(self, name):
-        labels = np.array(
-            h5py.File(f"{self.scene_to_path[name]}/labels.h5", "r")["GT_LABELS"]
-        )
+        with h5py.File(f"{self.scene_to_path[name]}/labels.h5", "r") as f:
+            labels = f["GT_LABELS"][self.get_window(f["GT_LABELS"])]
         labels = np.flip(labels, axis=0)
         return labels
 
-    def get_disparity(self, name, eps=1e-9):
-        scene = h5py.File(f"{self.scene_to_path[name]}/lf.h5", "r")
-        gt_depth = np.array(scene["GT_DEPTH"])
-        s_size, t_size = gt_depth.shape[:2]
-        gt_disparity = np.zeros_like(gt_depth)
+    def get_disparity(self, scene, eps=1e-9):
+        gt_disparity = scene["GT_DEPTH"][self.get_window(scene["GT_DEPTH"])]
         dH = scene.attrs["dH"][0]
         f = scene.attrs["focalLength"][0]
         shift = scene.attrs["shift"][0]
-        for s in range(s_size):
-            for t in range(t_size):
-                gt_disparity[s, t, :, :] = dH * f / (gt_depth[s, t] + eps) - shift
+        gt_disparity += eps  # depth to disparity in place
+        np.divide(dH * f, gt_disparity, out=gt_disparity)
+        gt_disparity -= shift
+        gt_disparity /= self.spatial_downscale  # disparity is in pixels
         return gt_disparity
 
     def __len__(self):
@@ -51,9 +78,10 @@ class HCIOldDataset:
 
     def __getitem__(self, idx):
         scene_name = self.scenes[idx]
-        LF = self.get_scene(scene_name)
+        with h5py.File(f"{self.scene_to_path[scene_name]}/lf.h5", "r") as scene:
+            LF = self.get_scene(scene)
+            disparity = self.get_disparity(scene)
         labels = self.get_labels(scene_name)
-        disparity = self.get_disparity(scene_name)
         return LF, labels, disparity
 
 
@@ -165,20 +193,34 @@ class UrbanLFRealDataset:
 
 
 class MMSPG:
-    def __init__(self, convert=True):
+    def __init__(self, convert=True, angular_window=9, spatial_downscale=1):
+        """
+        angular_window: int, read only the central window x window subviews,
+                        the default drops the outer ones affected by vignetting
+        spatial_downscale: int, read every n-th pixel of each subview
+        """
         self.path = "MMSPG"
         self.scenes = os.listdir(self.path)
         self.convert = convert
+        self.angular_window = angular_window
+        self.spatial_downscale = spatial_downscale
 
     def __len__(self):
         return len(self.scenes)
 
     def __getitem__(self, idx):
         scene_path = f"{self.path}/{self.scenes[idx]}"
-        LF = h5py.File(scene_path, "r")["LF"]
-        LF = np.transpose(LF, (4, 3, 2, 1, 0))[:, :, :, :, :3]
-        LF = LF[3:-3, 3:-3]  # drop subviews affected by vignetting
-        LF = (LF // 256).astype(np.uint8)
+        with h5py.File(scene_path, "r") as f:
+            c_size, v_size, u_size, t_size, s_size = f["LF"].shape
+            LF = f["LF"][
+                :3,  # stored as [c, v, u, t, s]
+                :: self.spatial_downscale,
+                :: self.spatial_downscale,
+                get_angular_slice(t_size, self.angular_window),
+                get_angular_slice(s_size, self.angular_window),
+            ]
+        LF >>= 8  # 16 to 8 bit in place
+        LF = np.transpose(LF, (4, 3, 2, 1, 0)).astype(np.uint8)
         LF = np.flip(LF, axis=(0, 1))
         return LF, None, None
 
@@ -1,19 +1,15 @@
-from data import HCIOldDataset, UrbanLFSynDataset, UrbanLFRealDataset, MMSPG
+from time import time
+
+START_TIME = time()
+
 import yaml
 import os
-import torch
-from metrics import ConsistencyMetrics, AccuracyMetrics
+import resource
 import pandas as pd
 import warnings
 from tqdm.auto import tqdm
-from sam2_functions import SAM2_CONFIG
-from sam2_baseline import (
-    sam2_baseline_LF_segmentation_dataset,
-    CONFIG as BASELINE_CONFIG,
-)
-from ours import sam_fast_LF_segmentation_dataset, CONFIG as OURS_CONFIG
 import argparse
-
+from registry import NAME_TO_DATASET, NAME_TO_METHOD, load_registered
 
 parser = argparse.ArgumentParser()
 parser.add_argument("filename", type=str)
@@ -38,51 +34,56 @@ def prepare_exp():
             raise FileExistsError(
                 f"experiments/{exp_name} exists. Continue progress or delete"
             )
+    with open("sam2_config.yaml") as f:
+        sam2_config = yaml.load(f, Loader=yaml.FullLoader)
     filenames = ["sam_config.yaml", args.filename]
-    configs = [SAM2_CONFIG, EXP_CONFIG]
+    configs = [sam2_config, EXP_CONFIG]
     for config, filename in zip(configs, filenames):
         with open(f"experiments/{exp_name}/{filename}", "w") as outfile:
             yaml.dump(config, outfile, default_flow_style=False)
 
 
 def get_datset():
-    name_to_dataset = {
-        "HCI": HCIOldDataset,
-        "URBAN_SYN": UrbanLFSynDataset,
-        "URBAN_REAL": UrbanLFRealDataset,
-        "MMSPG": MMSPG,
-    }
-    datset_name = EXP_CONFIG["dataset-name"]
-    dataset = name_to_dataset.get(datset_name)()
-    if not dataset:
-        raise ValueError(f"{EXP_CONFIG['dataset-name']} is not a valid datset name")
-    return dataset
+    dataset_class, _ = load_registered(NAME_TO_DATASET, EXP_CONFIG["dataset-name"])
+    return dataset_class(**EXP_CONFIG.get("dataset-args", {}))
 
 
 def get_method():
-    name_to_method = {
-        "baseline": sam2_baseline_LF_segmentation_dataset,
-        "ours": sam_fast_LF_segmentation_dataset,
-    }
-    config_to_method = {
-        "baseline": BASELINE_CONFIG,
-        "ours": OURS_CONFIG,
-    }
+    method, method_module = load_registered(NAME_TO_METHOD, EXP_CONFIG["method-name"])
     with open(
         f"experiments/{EXP_CONFIG['exp-name']}/method_config.yaml", "w"
     ) as outfile:
         yaml.dump(
-            config_to_method.get(EXP_CONFIG["method-name"]),
+            getattr(method_module, "CONFIG", {}),
             outfile,
             default_flow_style=False,
         )
-    method = name_to_method.get(EXP_CONFIG["method-name"])
-    if not method:
-        raise ValueError(f"{EXP_CONFIG['method-name']} is not a valid method name")
     return method
 
 
+def save_run_stats(startup_time):
+    """
+    Report startup time and peak resident memory of the run
+    """
+    import torch
+
+    run_stats = {
+        "startup-time-s": startup_time,
+        "total-time-s": time() - START_TIME,
+        "max-rss-mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+    if torch.cuda.is_available():
+        run_stats["max-gpu-memory-mb"] = torch.cuda.max_memory_allocated() / 2**20
+    print(run_stats)
+    with open(f"experiments/{EXP_CONFIG['exp-name']}/run_stats.yaml", "w") as outfile:
+        yaml.dump(run_stats, outfile, default_flow_style=False)
+
+
 def calculate_metrics(dataset):
+    import torch
+    from metrics import ConsistencyMetrics, AccuracyMetrics
+    from sam2_functions import DEVICE
+
     metrics_dataframe = []
     for idx in tqdm(
         range(len(dataset)), desc="metrics calculation", position=0, leave=True
@@ -93,17 +94,26 @@ def calculate_metrics(dataset):
         segment_file = f"experiments/{EXP_CONFIG['exp-name']}/{idx_padded}_segments.pt"
         if not (os.path.exists(mask_file) and os.path.exists(segment_file)):
             continue
-        mask_predictions = torch.load(mask_file)
+        mask_predictions = torch.load(mask_file, map_location=DEVICE)
         metrics_dict = {}
         is_real = EXP_CONFIG["dataset-name"] == "URBAN_REAL"
         if not is_real:
-            consistensy_metrics = ConsistencyMetrics(mask_predictions, disparity)
+            consistensy_metrics = ConsistencyMetrics(
+                mask_predictions,
+                disparity,
+                approximate=EXP_CONFIG.get("approximate-metrics", False),
+                tolerance=EXP_CONFIG.get("metrics-tolerance", 0.02),
+            )
             metrics_dict.update(consistensy_metrics.get_metrics_dict())
         del mask_predictions
         del consistensy_metrics
-        segment_predictions = torch.load(segment_file)
+        segment_predictions = torch.load(segment_file, map_location=DEVICE)
         accuracy_metrics = AccuracyMetrics(
-            segment_predictions, labels, only_central_subview=is_real
+            segment_predictions,
+            labels,
+            only_central_subview=is_real,
+            approximate=EXP_CONFIG.get("approximate-metrics", False),
+            tolerance=EXP_CONFIG.get("metrics-tolerance", 0.02),
         )
         metrics_dict.update(accuracy_metrics.get_metrics_dict())
         del segment_predictions
@@ -130,6 +140,8 @@ if __name__ == "__main__":
     prepare_exp()
     dataset = get_datset()
     method = get_method()
+    startup_time = time() - START_TIME
+    print(f"startup time: {startup_time:.2f}s")
     method(
         dataset,
         f"experiments/{EXP_CONFIG['exp-name']}",
@@ -137,3 +149,4 @@ if __name__ == "__main__":
     )
     if not EXP_CONFIG["dataset-name"] == "MMSPG":
         calculate_metrics(dataset)
+    save_run_stats(startup_time)
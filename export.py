@@ -0,0 +1,168 @@
+from time import time
+import os
+import numpy as np
+import torch
+from sam2_functions import (
+    SAM2_CONFIG,
+    DEVICE,
+    get_sam2_image_model,
+    get_image_predictor,
+    get_exported_paths,
+)
+
+
+class ImageEncoderOutputs(torch.nn.Module):
+    """
+    Image encoder with its output dict flattened to a tuple, which tracing keeps:
+    vision_features, *vision_pos_enc, *backbone_fpn
+    """
+
+    def __init__(self, image_encoder):
+        super().__init__()
+        self.image_encoder = image_encoder
+
+    def forward(self, sample):
+        output = self.image_encoder(sample)
+        return (
+            output["vision_features"],
+            *output["vision_pos_enc"],
+            *output["backbone_fpn"],
+        )
+
+
+class MaskDecoderCall(torch.nn.Module):
+    """
+    Mask decoder with the flags of SAM2ImagePredictor.predict for a single image
+    """
+
+    def __init__(self, mask_decoder, multimask_output):
+        super().__init__()
+        self.mask_decoder = mask_decoder
+        self.multimask_output = multimask_output
+
+    def forward(
+        self,
+        image_embeddings,
+        image_pe,
+        sparse_prompt_embeddings,
+        dense_prompt_embeddings,
+        *high_res_features,
+    ):
+        return self.mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            dense_prompt_embeddings=dense_prompt_embeddings,
+            multimask_output=self.multimask_output,
+            repeat_image=False,
+            high_res_features=list(high_res_features),
+        )
+
+
+def get_decoder_inputs(image_predictor, image, multimask_output=True):
+    """
+    Capture the mask decoder inputs of a point and box prompt, as used by
+    ours.refine_subview
+    returns: dict, decoder keyword arguments
+    """
+    captured = {}
+
+    def capture(module, args, kwargs):
+        captured.update(kwargs)
+
+    u, v = image.shape[:2]
+    handle = image_predictor.model.sam_mask_decoder.register_forward_pre_hook(
+        capture, with_kwargs=True
+    )
+    try:
+        image_predictor.set_image(image)
+        image_predictor.predict(
+            point_coords=np.array([[v / 2, u / 2]]),
+            point_labels=np.ones(1),
+            box=np.array([v / 4, u / 4, 3 * v / 4, 3 * u / 4]),
+            multimask_output=multimask_output,
+        )
+    finally:
+        handle.remove()
+    return captured
+
+
+def export_sam2(image_shape=(480, 640), multimask_output=True):
+    """
+    Trace the SAM2 image encoder and mask decoder with TorchScript and save them
+    with the remaining weights next to the checkpoint
+    image_shape: (int, int), light field subview resolution (u, v)
+    """
+    paths = get_exported_paths()
+    for path in paths.values():
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} exists, delete it to re-export")
+    sam2_img_model = get_sam2_image_model("none")
+    image_predictor = get_image_predictor(sam2_img_model)
+    image = np.zeros((*image_shape, 3), dtype=np.uint8)
+    decoder_inputs = get_decoder_inputs(image_predictor, image, multimask_output)
+    image_size = sam2_img_model.image_size
+    with torch.no_grad():
+        print("tracing the image encoder...", end="")
+        image_encoder = torch.jit.trace(
+            ImageEncoderOutputs(sam2_img_model.image_encoder).eval(),
+            torch.zeros((1, 3, image_size, image_size), device=DEVICE),
+            strict=False,
+        )
+        print("done")
+        print("tracing the mask decoder...", end="")
+        mask_decoder = torch.jit.trace(
+            MaskDecoderCall(sam2_img_model.sam_mask_decoder, multimask_output).eval(),
+            (
+                decoder_inputs["image_embeddings"],
+                decoder_inputs["image_pe"],
+                decoder_inputs["sparse_prompt_embeddings"],
+                decoder_inputs["dense_prompt_embeddings"],
+                *decoder_inputs["high_res_features"],
+            ),
+            strict=False,
+        )
+        print("done")
+    torch.jit.save(image_encoder, paths["image_encoder"])
+    torch.jit.save(mask_decoder, paths["mask_decoder"])
+    state_dict = {
+        key: value
+        for key, value in sam2_img_model.state_dict().items()
+        if not key.startswith("image_encoder.")
+    }
+    torch.save(
+        {
+            "state_dict": state_dict,
+            "decoder-sparse-shape": list(
+                decoder_inputs["sparse_prompt_embeddings"].shape
+            ),
+            "decoder-multimask-output": multimask_output,
+        },
+        paths["state_dict"],
+    )
+    print(f"saved {', '.join(paths.values())}")
+
+
+def time_to_first_mask(image_shape=(480, 640)):
+    """
+    Seconds from building the model to the first decoded mask
+    """
+    start_time = time()
+    image_predictor = get_image_predictor()
+    image = np.zeros((*image_shape, 3), dtype=np.uint8)
+    get_decoder_inputs(image_predictor, image)
+    return time() - start_time
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--u", type=int, default=480)  # subview height
+    parser.add_argument("--v", type=int, default=640)  # subview width
+    args = parser.parse_args()
+    export_sam2((args.u, args.v))
+    print(
+        f"time to first mask with {SAM2_CONFIG['sam-checkpoint']} exports: "
+        f"{time_to_first_mask((args.u, args.v)):.2f}s"
+    )
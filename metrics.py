@@ -1,38 +1,145 @@
-from data import UrbanLFSynDataset, HCIOldDataset
-from utils import visualize_segmentation_mask, masks_to_segments
-from plenpy.lightfields import LightField
-import numpy as np
+import math
 import torch
-import matplotlib.pyplot as plt
 import torch.nn.functional as F
-from utils import masks_iou
+from utils import masks_iou, segment_boundaries
+
+
+def estimate_mean(
+    sample_batch,
+    tolerance=0.02,
+    min_batches=5,
+    max_batches=50,
+    z=1.96,
+    abs_tolerance=1e-3,
+):
+    """
+    Batch means estimate of metrics with a normal confidence interval. Batches are
+    drawn until every interval half-width is under tolerance relative to its mean,
+    or under abs_tolerance for means close to 0
+    sample_batch: function () -> list of float, metrics on one random batch,
+                  batches with a nan are skipped
+    returns: (list of float, list of float), means and interval half-widths
+    """
+    values = []
+    for _ in range(max_batches):
+        value = sample_batch()
+        if not any(math.isnan(value_i) for value_i in value):
+            values.append(value)
+        if len(values) >= min_batches:
+            values_t = torch.tensor(values)
+            means = values_t.mean(dim=0)
+            half_widths = z * values_t.std(dim=0) / math.sqrt(len(values))
+            limits = (tolerance * means.abs()).clamp(min=abs_tolerance)
+            if (half_widths <= limits).all():
+                break
+    if len(values) < 2:  # no interval, nan unless a single batch succeeded
+        means = torch.tensor(values[0] if values else [float("nan")] * len(value))
+        half_widths = torch.full_like(means, float("nan"))
+    else:
+        values_t = torch.tensor(values)
+        means = values_t.mean(dim=0)
+        half_widths = z * values_t.std(dim=0) / math.sqrt(len(values))
+    return means.tolist(), half_widths.tolist()
 
 
 class ConsistencyMetrics:
-    def __init__(self, predicted_masks, gt_disparity):
+    def __init__(
+        self,
+        predicted_masks,
+        gt_disparity,
+        approximate=False,
+        tolerance=0.02,
+        seed=0,
+        batch_pixels=4096,
+        batch_subviews=4,
+    ):
+        """
+        approximate: bool, estimate metrics on random subviews, masks and pixels
+                     instead of projecting every mask to every subview
+        tolerance: float, relative confidence interval half-width to stop sampling
+        """
         s_size, t_size = gt_disparity.shape[:2]
-        predictions = predicted_masks  # [n, s, t, u, v]
-        disparity = torch.tensor(gt_disparity.copy()).cuda()
-        self.masks_projected = torch.zeros_like(predictions, dtype=torch.bool).cuda()
-        for i, prediction in enumerate(predictions):
+        self.predictions = predicted_masks  # [n, s, t, u, v]
+        self.disparity = torch.tensor(gt_disparity.copy()).to(predicted_masks.device)
+        self.approximate = approximate
+        self.tolerance = tolerance
+        self.batch_pixels = batch_pixels
+        self.batch_subviews = batch_subviews
+        self.generator = torch.Generator().manual_seed(seed)
+        if approximate:
+            return
+        self.masks_projected = torch.zeros_like(self.predictions, dtype=torch.bool)
+        for i in range(self.predictions.shape[0]):
             for s in range(s_size):
                 for t in range(t_size):
-                    prediction_st = prediction[s, t]
-                    st = torch.tensor([s - s_size // 2, t - t_size // 2]).float().cuda()
-                    uv_0 = torch.nonzero(prediction_st)
-                    disparities_uv = disparity[s, t][prediction_st].reshape(-1)
-                    uv = (uv_0 - disparities_uv.unsqueeze(1) * st).long()
-                    u = uv[:, 0]
-                    v = uv[:, 1]
-                    uv = uv[
-                        (u >= 0)
-                        & (v >= 0)
-                        & (u < prediction_st.shape[0])
-                        & (v < prediction_st.shape[1])
-                    ]
-                    mask_projected = torch.zeros_like(prediction_st)
-                    mask_projected[uv[:, 0], uv[:, 1]] = True
-                    self.masks_projected[i, s, t] = mask_projected
+                    self.masks_projected[i, s, t] = self.project_mask(i, s, t)
+
+    def project_mask(self, i, s, t):
+        """
+        Project mask i of subview (s, t) to the central subview with GT disparity
+        returns: torch.tensor [u, v] (torch.bool)
+        """
+        s_size, t_size = self.disparity.shape[:2]
+        prediction_st = self.predictions[i, s, t]
+        st = torch.tensor([s - s_size // 2, t - t_size // 2]).float()
+        st = st.to(prediction_st.device)
+        uv_0 = torch.nonzero(prediction_st)
+        disparities_uv = self.disparity[s, t][prediction_st].reshape(-1)
+        uv = (uv_0 - disparities_uv.unsqueeze(1) * st).long()
+        u = uv[:, 0]
+        v = uv[:, 1]
+        uv = uv[
+            (u >= 0)
+            & (v >= 0)
+            & (u < prediction_st.shape[0])
+            & (v < prediction_st.shape[1])
+        ]
+        mask_projected = torch.zeros_like(prediction_st)
+        mask_projected[uv[:, 0], uv[:, 1]] = True
+        return mask_projected
+
+    def randint(self, high, size=()):
+        return torch.randint(high, size, generator=self.generator)
+
+    def labels_per_pixel_batch(self):
+        """
+        labels_per_pixel on random segmented pixels of one random subview
+        """
+        s_size, t_size = self.disparity.shape[:2]
+        s, t = self.randint(s_size).item(), self.randint(t_size).item()
+        n_labels_at_pixel = torch.stack(
+            [self.project_mask(i, s, t) for i in range(self.predictions.shape[0])]
+        ).sum(axis=0)
+        n_labels_at_pixel = n_labels_at_pixel[n_labels_at_pixel > 0]
+        if n_labels_at_pixel.shape[0] == 0:
+            return [float("nan")]
+        pixels = self.randint(n_labels_at_pixel.shape[0], (self.batch_pixels,))
+        pixels = pixels.to(n_labels_at_pixel.device)
+        return [n_labels_at_pixel[pixels].float().mean().item()]
+
+    def self_similarity_batch(self):
+        """
+        self_similarity and self_iou of one random mask on random subviews
+        """
+        s_size, t_size = self.disparity.shape[:2]
+        i = self.randint(self.predictions.shape[0]).item()
+        mask_central = self.project_mask(i, s_size // 2, t_size // 2)
+        centroid_orig = torch.nonzero(mask_central).float().mean(axis=0)
+        values = []
+        ious = []
+        for st in self.randint(s_size * t_size, (self.batch_subviews,)).tolist():
+            s, t = divmod(st, t_size)
+            if s == s_size // 2 and t == t_size // 2:
+                continue
+            mask_st = self.project_mask(i, s, t)
+            if mask_st.sum() == 0:
+                continue
+            centroid = torch.nonzero(mask_st).float().mean(axis=0)
+            values.append(torch.norm(centroid - centroid_orig).item())
+            ious.append(masks_iou(mask_st[None], mask_central)[0].item())
+        if len(values) == 0:
+            return [float("nan"), float("nan")]
+        return [sum(values) / len(values), sum(ious) / len(ious)]
 
     def labels_per_pixel(self):
         """
@@ -86,6 +193,21 @@ class ConsistencyMetrics:
         return values.mean().item(), ious.mean().item()
 
     def get_metrics_dict(self):
+        if self.approximate:
+            (labels_per_pixel,), (labels_per_pixel_ci,) = estimate_mean(
+                self.labels_per_pixel_batch, self.tolerance
+            )
+            (self_similarity, self_iou), (self_similarity_ci, self_iou_ci) = (
+                estimate_mean(self.self_similarity_batch, self.tolerance)
+            )
+            return {
+                "labels_per_pixel": labels_per_pixel,
+                "labels_per_pixel_ci": labels_per_pixel_ci,
+                "self_similarity": self_similarity,
+                "self_similarity_ci": self_similarity_ci,
+                "self_iou": self_iou,
+                "self_iou_ci": self_iou_ci,
+            }
         labels_per_pixel = self.labels_per_pixel()
         self_similarity, self_iou = self.self_similarity()
         result = {
@@ -96,19 +218,50 @@ class ConsistencyMetrics:
         return result
 
 
+def dilate(masks, d):
+    """
+    Dilate every subview with a (2d + 1) x (2d + 1) square, as two separable
+    max pools over all subviews at once
+    masks: torch.tensor [s, t, u, v] (torch.bool)
+    returns: torch.tensor [s, t, u, v] (torch.bool)
+    """
+    s, t, u, v = masks.shape
+    dilated = masks.reshape(s * t, 1, u, v).float()
+    dilated = F.max_pool2d(dilated, (2 * d + 1, 1), stride=1, padding=(d, 0))
+    dilated = F.max_pool2d(dilated, (1, 2 * d + 1), stride=1, padding=(0, d))
+    return dilated.reshape(s, t, u, v) > 0
+
+
 class AccuracyMetrics:
-    def __init__(self, predicted_segments, gt_segments, only_central_subview=False):
+    def __init__(
+        self,
+        predicted_segments,
+        gt_segments,
+        only_central_subview=False,
+        approximate=False,
+        tolerance=0.02,
+        seed=0,
+        batch_pixels=65536,
+    ):
+        """
+        approximate: bool, estimate metrics on random pixels
+        tolerance: float, relative confidence interval half-width to stop sampling
+        """
         if only_central_subview:
             s, t, u, v = predicted_segments.shape
-            predicpredicted_segmentstions = predicted_segments[s // 2, t // 2, :, :][
+            predicted_segments = predicted_segments[s // 2, t // 2, :, :][
                 None, None, :, :
             ]
             gt_segments = gt_segments[None, None, :, :]
         self.predictions = predicted_segments
-        self.gt_labels = torch.tensor(gt_segments.copy()).cuda()
+        self.gt_labels = torch.tensor(gt_segments.copy()).to(predicted_segments.device)
         self.s, self.t, self.u, self.v = self.predictions.shape
         self.n_pixels = self.s * self.t * self.u * self.v
         self.boundary_d = 2
+        self.approximate = approximate
+        self.tolerance = tolerance
+        self.batch_pixels = batch_pixels
+        self.generator = torch.Generator().manual_seed(seed)
 
     def achievable_accuracy(self):
         """
@@ -154,23 +307,106 @@ class AccuracyMetrics:
                 overlap = (predicted_region.long() * gt_region.long()).sum()
                 total_penalty += min(overlap, predicted_region.sum() - overlap)
             undersegmentation_errors.append(total_penalty / gt_region.sum())
-        return torch.tensor(undersegmentation_errors).cuda().mean().item()
+        return torch.tensor(undersegmentation_errors).mean().item()
+
+    def boundary_recall(self):
+        """
+        Fraction of GT boundary pixels within boundary_d of a predicted boundary
+        D. Martin, C. Fowlkes, J. Malik.
+        Learning to detect natural image boundaries using local brightness, color,
+        and texture cues.
+        IEEE Transactions on Pattern Analysis and Machine Intelligence, 2004.
+        """
+        return self.boundary_metrics()[0]
+
+    def boundary_precision(self):
+        """
+        Fraction of predicted boundary pixels within boundary_d of a GT boundary
+        """
+        return self.boundary_metrics()[1]
+
+    def boundary_metrics(self):
+        """
+        returns: (float, float, float), boundary recall, precision and F-measure
+        """
+        predicted_boundaries = segment_boundaries(self.predictions)
+        gt_boundaries = segment_boundaries(self.gt_labels)
+        recall = (
+            (gt_boundaries & dilate(predicted_boundaries, self.boundary_d)).sum()
+            / gt_boundaries.sum().clamp(min=1)
+        ).item()
+        precision = (
+            (predicted_boundaries & dilate(gt_boundaries, self.boundary_d)).sum()
+            / predicted_boundaries.sum().clamp(min=1)
+        ).item()
+        f_measure = 2 * precision * recall / max(precision + recall, 1e-9)
+        return recall, precision, f_measure
+
+    def accuracy_batch(self):
+        """
+        achievable_accuracy, coverage and undersegmentation_error of random pixels,
+        from their prediction / GT contingency table
+        """
+        pixels = torch.randint(
+            self.n_pixels, (self.batch_pixels,), generator=self.generator
+        ).to(self.predictions.device)
+        predictions = self.predictions.reshape(-1)[pixels].long()
+        gt_labels = self.gt_labels.reshape(-1)[pixels].long()
+        n_predicted = int(self.predictions.max()) + 1
+        n_gt = int(self.gt_labels.max()) + 1
+        table = (
+            torch.bincount(predictions * n_gt + gt_labels, minlength=n_predicted * n_gt)
+            .reshape(n_predicted, n_gt)
+            .float()
+        )
+        gt_modes = table.argmax(dim=1)
+        gt_modes[0] = 0  # label 0 is the unsegmented region
+        predictions_modified = gt_modes[predictions]
+        segmented = predictions_modified != 0
+        achievable_accuracy = (
+            (predictions_modified[segmented] == gt_labels[segmented]).float().mean()
+        )
+        coverage = (predictions >= 1).float().mean()
+        penalty = torch.minimum(table, table.sum(dim=1, keepdim=True) - table)
+        gt_areas = table.sum(dim=0)
+        undersegmentation_error = (
+            penalty[1:].sum(dim=0)[gt_areas > 0] / gt_areas[gt_areas > 0]
+        ).mean()
+        return [
+            achievable_accuracy.item(),
+            coverage.item(),
+            undersegmentation_error.item(),
+        ]
 
     def get_metrics_dict(self):
-        achievable_accuracy, _ = self.achievable_accuracy()
-        coverage = self.coverage()
-        undersegmentation_error = self.undersegmentation_error()
+        # boundary metrics are exact, dilating all subviews is cheap enough
+        boundary_recall, boundary_precision, boundary_f_measure = (
+            self.boundary_metrics()
+        )
         result = {
-            "achievable_accuracy": achievable_accuracy,
-            "coverage": coverage,
-            "undersegmentation_error": undersegmentation_error,
+            "boundary_recall": boundary_recall,
+            "boundary_precision": boundary_precision,
+            "boundary_f_measure": boundary_f_measure,
         }
+        if self.approximate:
+            names = ["achievable_accuracy", "coverage", "undersegmentation_error"]
+            means, half_widths = estimate_mean(self.accuracy_batch, self.tolerance)
+            for name, mean, half_width in zip(names, means, half_widths):
+                result[name] = mean
+                result[f"{name}_ci"] = half_width
+            return result
+        achievable_accuracy, _ = self.achievable_accuracy()
+        result["achievable_accuracy"] = achievable_accuracy
+        result["coverage"] = self.coverage()
+        result["undersegmentation_error"] = self.undersegmentation_error()
         return result
 
 
 if __name__ == "__main__":
+    from data import UrbanLFSynDataset
+
     data = UrbanLFSynDataset("UrbanLF_Syn/val")
     LF, labels, disp = data[0]
-    ours = torch.load("experiments/ours/0000_segments.pt")
+    ours = torch.load("experiments/ours/0000_segments.pt", map_location="cpu")
     metrics = AccuracyMetrics(ours[3:-3, 3:-3], labels[3:-3, 3:-3])
     print(metrics.boundary_recall())
@@ -1,23 +1,34 @@
 from sam2_functions import (
+    SAM2_CONFIG,
+    DEVICE,
     get_auto_mask_predictor,
     get_sam_1_auto_mask_predictor,
     generate_image_masks,
+    get_image_masks_from_boxes,
 )
-from data import HCIOldDataset, UrbanLFSynDataset
 import warnings
 from utils import (
     visualize_segmentation_mask,
     masks_iou,
     masks_to_segments,
+    get_segment_order,
+    subview_masks_to_segments,
     predict_mask_subview_position,
+    shift_mask,
+    remap_labels,
 )
+from artifacts import ArtifactStore, get_scene_key
+from pipeline import StagedExecutor, StageError
+from timings import make_timing_record, append_timing_record, get_scene_name
 from time import time
 import torch
 import yaml
 import os
-import matplotlib.pyplot as plt
+import math
+import tempfile
 import numpy as np
 from torchvision.transforms.functional import resize
+from torchvision.ops import masks_to_boxes
 import torch.nn.functional as F
 from utils import get_LF_disparities
 
@@ -27,6 +38,40 @@ with open("ours.yaml") as f:
     CONFIG = yaml.load(f, Loader=yaml.FullLoader)
 
 
+def get_pruned_masks(
+    masks,
+    iou_thresh=CONFIG["prune-iou"],
+    min_area=CONFIG["prune-min-area"],
+    containment_thresh=CONFIG["prune-containment"],
+    fragment_area=CONFIG["prune-fragment-area"],
+):
+    """
+    Select masks worth propagating from pairwise IoU and containment of all masks,
+    computed with one matmul. A mask is dropped when it is tiny, a near-duplicate
+    of a bigger mask or a small fragment lying inside a bigger mask
+    masks: torch.tensor [n, u, v] (torch.bool)
+    returns: torch.tensor [n] (torch.bool), masks to keep
+    """
+    n, u, v = masks.shape
+    masks_flat = masks.reshape(n, -1).float()
+    intersections = masks_flat @ masks_flat.T  # [n, n]
+    del masks_flat
+    areas = intersections.diagonal()
+    ious = intersections / (areas[:, None] + areas[None] - intersections + 1e-9)
+    containment = intersections / (areas[:, None] + 1e-9)  # part of i inside j
+    rank = torch.empty_like(areas, dtype=torch.long)
+    rank[torch.argsort(areas, descending=True)] = torch.arange(n, device=masks.device)
+    bigger = rank[None] < rank[:, None]  # j is bigger than i
+    duplicate = ((ious >= iou_thresh) & bigger).any(dim=1)
+    fragment = (
+        (containment >= containment_thresh)
+        & (areas[:, None] <= fragment_area * areas[None])
+        & bigger
+    ).any(dim=1)
+    tiny = areas / float(u * v) < min_area
+    return ~(duplicate | fragment | tiny)
+
+
 def get_mask_disparities(masks_central, disparities):
     """
     Get mean disparity of each mask
@@ -34,7 +79,7 @@ def get_mask_disparities(masks_central, disparities):
     disparities: np.array [u, v] (np.float32)
     returns: torch.tensor [n] (torch.float32)
     """
-    mask_disparities = torch.zeros((masks_central.shape[0],)).cuda()
+    mask_disparities = torch.zeros((masks_central.shape[0],)).to(DEVICE)
     for i, mask_i in enumerate(masks_central):
         disparities_i = disparities[mask_i]
         disparities_i = disparities_i[~torch.any(disparities_i.isnan())]
@@ -42,22 +87,111 @@ def get_mask_disparities(masks_central, disparities):
     return mask_disparities
 
 
+def get_mask_disparity_variances(masks_central, disparities):
+    """
+    Get disparity variance inside each mask
+    masks_central: torch.tensor [n, u, v] (torch.bool)
+    disparities: torch.tensor [u, v] (torch.float32)
+    returns: torch.tensor [n] (torch.float32)
+    """
+    variances = torch.zeros((masks_central.shape[0],)).to(DEVICE)
+    for i, mask_i in enumerate(masks_central):
+        disparities_i = disparities[mask_i]
+        disparities_i = disparities_i[~disparities_i.isnan()]
+        if disparities_i.shape[0] > 1:
+            variances[i] = torch.var(disparities_i)
+    return variances
+
+
+def _anchor_positions(size, central, stride):
+    return list(range(central % stride, size, stride))
+
+
+def get_anchor_subviews(
+    s_size, t_size, mode=CONFIG["anchor-mode"], stride=CONFIG["anchor-stride"]
+):
+    """
+    Select subviews refined with SAM, the rest are warped from them
+    mode: str, one of [all, corners, cross, grid]
+    stride: int, distance between anchors for cross and grid modes
+    returns: torch.tensor [s, t] (torch.bool)
+    """
+    s_central, t_central = s_size // 2, t_size // 2
+    anchors = torch.zeros((s_size, t_size), dtype=torch.bool)
+    if mode == "all":
+        anchors[:, :] = True
+    elif mode == "corners":
+        anchors[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+    elif mode == "cross":
+        anchors[s_central, _anchor_positions(t_size, t_central, stride)] = True
+        anchors[_anchor_positions(s_size, s_central, stride), t_central] = True
+    elif mode == "grid":
+        for s in _anchor_positions(s_size, s_central, stride):
+            anchors[s, _anchor_positions(t_size, t_central, stride)] = True
+    else:
+        raise ValueError(f"{mode} is not a valid anchor mode")
+    anchors[s_central, t_central] = True
+    return anchors
+
+
+def get_nearest_anchor(anchors, s, t):
+    """
+    Find the anchor subview closest to (s, t), ties go to the central one
+    anchors: torch.tensor [s, t] (torch.bool)
+    returns: (int, int)
+    """
+    s_size, t_size = anchors.shape
+    anchor_st = torch.nonzero(anchors).float()
+    distances = torch.norm(anchor_st - torch.tensor([s, t]).float(), dim=1)
+    distances_central = torch.norm(
+        anchor_st - torch.tensor([s_size // 2, t_size // 2]).float(), dim=1
+    )
+    nearest = torch.argmin(distances + 1e-3 * distances_central)
+    return tuple(anchor_st[nearest].long().tolist())
+
+
 @torch.no_grad()
-def get_subview_embeddings(predictor_model, LF):
-    "[s, t, 64, 64, 256] Get image embeddings for each LF subview"
+def get_subview_embeddings(predictor_model, LF, anchors=None):
+    "[s, t, 64, 64, 256] Get image embeddings for each LF subview (anchors only)"
     print("getting subview embeddings...", end="")
     s_size, t_size, _, _ = LF.shape[:-1]
-    results = []
+    results = torch.zeros((s_size, t_size, 64, 64, 256)).to(DEVICE)
     for s in range(s_size):
         for t in range(t_size):
+            if anchors is not None and not anchors[s, t]:
+                continue
             predictor_model.set_image(LF[s, t])
             embedding = predictor_model.get_image_embedding()
-            results.append(embedding[0].permute(1, 2, 0))
-    results = torch.stack(results).reshape(s_size, t_size, 64, 64, 256).cuda()
+            results[s, t] = embedding[0].permute(1, 2, 0)
     print("done")
     return results
 
 
+@torch.no_grad()
+def get_subview_embeddings_batch(predictor_model, LFs, anchors, batch_size=8):
+    """
+    Get image embeddings for anchor subviews of several LFs with batched encoder calls
+    LFs: list of np.array [s, t, u, v, 3] (np.uint8)
+    anchors: list of torch.tensor [s, t] (torch.bool)
+    returns: list of torch.tensor [s, t, 64, 64, 256]
+    """
+    results = [
+        torch.zeros((LF.shape[0], LF.shape[1], 64, 64, 256)).to(DEVICE) for LF in LFs
+    ]
+    positions = [
+        (lf_i, s, t)
+        for lf_i, anchors_i in enumerate(anchors)
+        for s, t in torch.nonzero(anchors_i).tolist()
+    ]
+    for batch_start in range(0, len(positions), batch_size):
+        batch = positions[batch_start : batch_start + batch_size]
+        predictor_model.set_image_batch([LFs[lf_i][s, t] for lf_i, s, t in batch])
+        embeddings = predictor_model.get_image_embedding()
+        for (lf_i, s, t), embedding in zip(batch, embeddings):
+            results[lf_i][s, t] = embedding.permute(1, 2, 0)
+    return results
+
+
 def get_coarse_matching(LF, masks_central, mask_disparities, disparities):
     """
     Predict subview masks using disparities
@@ -69,7 +203,7 @@ def get_coarse_matching(LF, masks_central, mask_disparities, disparities):
     s_size, t_size, u_size, v_size = LF.shape[:4]
     result = torch.zeros(
         (masks_central.shape[0], s_size, t_size, u_size, v_size), dtype=torch.bool
-    ).cuda()
+    ).to(DEVICE)
     for s in range(s_size):
         for t in range(t_size):
             for i, (mask, disparity) in enumerate(zip(masks_central, mask_disparities)):
@@ -83,6 +217,8 @@ def get_coarse_matching(LF, masks_central, mask_disparities, disparities):
 def refine_coarse_masks_semantic(
     subview_embeddings,
     coarse_masks,
+    anchors=None,
+    sim_thresh=CONFIG["sim-thresh"],
 ):
     n_masks, s_size, t_size, u_size, v_size = coarse_masks.shape
     coarse_masks = coarse_masks.to(torch.float16)
@@ -95,6 +231,8 @@ def refine_coarse_masks_semantic(
             for t in range(t_size):
                 if s == s_size // 2 and t == t_size // 2:
                     continue
+                if anchors is not None and not anchors[s, t]:
+                    continue
                 mask_st = coarse_masks[mask_i, s, t]
                 embeddings_st = subview_embeddings[s, t]
                 embeddings_st = resize(embeddings_st.permute(2, 0, 1), (u_size, v_size))
@@ -102,9 +240,7 @@ def refine_coarse_masks_semantic(
                 similarities = F.cosine_similarity(
                     embeddings_st.T, mask_embedding[:, None].T
                 )
-                similarities = (
-                    similarities * (similarities > CONFIG["sim-thresh"]).float()
-                )
+                similarities = similarities * (similarities > sim_thresh).float()
                 coarse_masks[mask_i, s, t][mask_st == 1] = similarities.to(
                     torch.float16
                 )
@@ -114,20 +250,26 @@ def refine_coarse_masks_semantic(
     return coarse_masks
 
 
-def get_prompts_for_masks(coarse_masks):
+def get_prompts_for_masks(
+    coarse_masks, anchors=None, use_semantic=CONFIG["use-semantic"]
+):
     """
     Calculate prompts from coarse masks
-    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool)
+    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool), or semantically
+                  weighted (torch.float16) with use_semantic
+    anchors: torch.tensor [s, t] (torch.bool), subviews to calculate prompts for
     returns: torch.tensor [n, s, t, 2] (torch.float),
              torch.tensor [n, s, t, 4] (torch.float)
     """
     n, s_size, t_size = coarse_masks.shape[:3]
-    point_prompts = torch.zeros((n, s_size, t_size, 2), dtype=torch.float).cuda()
-    box_prompts = torch.zeros((n, s_size, t_size, 4), dtype=torch.float).cuda()
+    point_prompts = torch.zeros((n, s_size, t_size, 2), dtype=torch.float).to(DEVICE)
+    box_prompts = torch.zeros((n, s_size, t_size, 4), dtype=torch.float).to(DEVICE)
     for s in range(s_size):
         for t in range(t_size):
             if s == s_size // 2 and t == t_size // 2:
                 continue
+            if anchors is not None and not anchors[s, t]:
+                continue
             for mask_i, mask in enumerate(coarse_masks[:, s, t]):
                 point_prompts_i = torch.nonzero(mask).flip(1)
                 if point_prompts_i.shape[0] == 0:
@@ -139,8 +281,8 @@ def get_prompts_for_masks(coarse_masks):
                         point_prompts_i[:, 0].max(),
                         point_prompts_i[:, 1].max(),
                     ]
-                ).cuda()
-                if CONFIG["use-semantic"]:
+                ).to(DEVICE)
+                if use_semantic:
                     weights = mask[point_prompts_i[:, 1], point_prompts_i[:, 0]].float()
                     point_prompts_i_centroid = (
                         point_prompts_i.float().T @ weights[:, None]
@@ -157,47 +299,228 @@ def get_prompts_for_masks(coarse_masks):
     return point_prompts, box_prompts
 
 
-def get_refined_matching(LF, image_predictor, coarse_masks, point_prompts, box_prompts):
+def get_confident_masks(
+    coarse_masks,
+    weighted_coarse_masks,
+    disparity_variances,
+    min_similarity=CONFIG["early-exit-sim"],
+    min_area=CONFIG["early-exit-area"],
+    max_disparity_variance=CONFIG["early-exit-disp-var"],
+):
     """
-    Predict subview masks using disparities
+    Find coarse masks consistent enough to skip SAM refinement
+    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool)
+    weighted_coarse_masks: torch.tensor [n, s, t, u, v] (torch.float16) or None
+    disparity_variances: torch.tensor [n] (torch.float32)
+    returns: torch.tensor [n, s, t] (torch.bool)
+    """
+    n, s_size, t_size = coarse_masks.shape[:3]
+    confident = torch.zeros((n, s_size, t_size), dtype=torch.bool).to(DEVICE)
+    for mask_i in range(n):
+        if disparity_variances[mask_i] > max_disparity_variance:
+            continue
+        areas = coarse_masks[mask_i].sum(dim=(2, 3)).float()
+        area_ratios = areas / areas[s_size // 2, t_size // 2].clamp(min=1)
+        confident_i = area_ratios >= min_area
+        if weighted_coarse_masks is not None:
+            similarities = weighted_coarse_masks[mask_i].float().sum(
+                dim=(2, 3)
+            ) / areas.clamp(min=1)
+            confident_i &= similarities >= min_similarity
+        confident[mask_i] = confident_i
+    confident[:, s_size // 2, t_size // 2] = False
+    return confident
+
+
+def get_ring_order(s_size, t_size):
+    """
+    Subview indices ordered by rings around the central subview
+    returns: list of (int, int), the central subview first
+    """
+    s_central, t_central = s_size // 2, t_size // 2
+    return sorted(
+        [(s, t) for s in range(s_size) for t in range(t_size)],
+        key=lambda st: (max(abs(st[0] - s_central), abs(st[1] - t_central)), st),
+    )
+
+
+def warp_anchor_masks(anchor_masks, mask_disparities, s, t):
+    """
+    Warp refined anchor subview masks to a subview at angular offset (s, t)
+    anchor_masks: torch.tensor [n, u, v] (torch.bool)
+    mask_disparities: torch.tensor [n] (torch.float32)
+    returns: torch.tensor [n, u, v] (torch.bool)
+    """
+    result = torch.zeros_like(anchor_masks)
+    for i, (mask, disparity) in enumerate(zip(anchor_masks, mask_disparities)):
+        result[i] = shift_mask(mask, disparity, s, t)
+    return result
+
+
+def decode_subview(
+    image_predictor,
+    coarse_masks_st,
+    point_prompts_st,
+    box_prompts_st,
+    to_refine,
+    stats=None,
+):
+    """
+    Decode SAM masks for the prompts of one subview, whose image is already set
+    image_predictor: SAM2ImagePredictor
+    coarse_masks_st: torch.tensor [n, u, v] (torch.bool)
+    point_prompts_st: torch.tensor [n, 2] (torch.float)
+    box_prompts_st: torch.tensor [n, 4] (torch.float)
+    to_refine: torch.tensor [n] (torch.bool), masks to decode
+    stats: dict, decoder call counter
+    returns: torch.tensor [n, u, v] (torch.bool), the SAM mask best matching each
+             coarse mask (the coarse one if not decoded),
+             torch.tensor [n] (torch.float), its IoU with the coarse mask
+    """
+    fine_masks_st = torch.clone(coarse_masks_st)
+    fine_ious = torch.zeros(coarse_masks_st.shape[0]).to(DEVICE)
+    for segment_i, (point_prompts_i, box_prompts_i) in enumerate(
+        zip(point_prompts_st, box_prompts_st)
+    ):
+        if not to_refine[segment_i]:
+            continue
+        point_prompts_i = point_prompts_i[None]
+        labels = torch.ones(point_prompts_i.shape[0])
+        fine_segment_result, _, _ = image_predictor.predict(
+            point_coords=point_prompts_i,
+            point_labels=labels,
+            box=box_prompts_i,
+            multimask_output=True,
+        )
+        if stats is not None:
+            stats["decoder_calls"] = stats.get("decoder_calls", 0) + 1
+        fine_segment_result = torch.tensor(
+            fine_segment_result, dtype=torch.bool, device=DEVICE
+        )
+        ious = masks_iou(fine_segment_result, coarse_masks_st[segment_i])
+        match_idx = torch.argmax(ious)
+        fine_masks_st[segment_i] = fine_segment_result[match_idx]
+        fine_ious[segment_i] = ious[match_idx]
+    return fine_masks_st, fine_ious
+
+
+def refine_subview(
+    LF_st,
+    image_predictor,
+    coarse_masks_st,
+    point_prompts_st,
+    box_prompts_st,
+    skip_masks_st=None,
+    stats=None,
+    iou_thresh=CONFIG["iou-thresh"],
+):
+    """
+    Replace coarse masks of one subview with matching SAM masks
+    LF_st: np.array [u, v, 3] (np.uint8)
+    image_predictor: SAM2ImagePredictor
+    coarse_masks_st: torch.tensor [n, u, v] (torch.bool)
+    point_prompts_st: torch.tensor [n, 2] (torch.float)
+    box_prompts_st: torch.tensor [n, 4] (torch.float)
+    skip_masks_st: torch.tensor [n] (torch.bool), coarse masks kept as is
+    stats: dict, encoder and decoder call counters
+    returns: torch.tensor [n, u, v] (torch.bool)
+    """
+    refined_masks_st = torch.clone(coarse_masks_st)
+    to_refine = point_prompts_st.sum(dim=1) > 1e-6
+    if skip_masks_st is not None:
+        to_refine &= ~skip_masks_st
+    if not to_refine.any():
+        return refined_masks_st
+    image_predictor.set_image(LF_st)
+    if stats is not None:
+        stats["encoder_calls"] = stats.get("encoder_calls", 0) + 1
+    fine_masks_st, fine_ious = decode_subview(
+        image_predictor,
+        coarse_masks_st,
+        point_prompts_st,
+        box_prompts_st,
+        to_refine,
+        stats,
+    )
+    matched = fine_ious > iou_thresh
+    refined_masks_st[matched] = fine_masks_st[matched]  # replacing coarse masks
+    return refined_masks_st
+
+
+def iterate_refined_matching(
+    LF,
+    image_predictor,
+    coarse_masks,
+    point_prompts,
+    box_prompts,
+    anchors=None,
+    mask_disparities=None,
+    skip_masks=None,
+    stats=None,
+):
+    """
+    Refine subviews ring by ring around the central one, yielding each when done
     LF: np.array [s, t, u, v, 3] (np.uint8)
     image_predictor: SAM2ImagePredictor
-    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool)
-    returns: torch.tensor [n, s, t, u, v] (torch.bool)
+    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool), on device or spilled
+    anchors: torch.tensor [s, t] (torch.bool), subviews refined with SAM,
+             the rest are warped from the nearest one using mask_disparities,
+             an anchor's masks stay on the device until its last warp
+    mask_disparities: torch.tensor [n] (torch.float32)
+    skip_masks: torch.tensor [n, s, t] (torch.bool), coarse masks kept as is
+    stats: dict, filled with the number of encoder and decoder calls
+    yields: int, int, torch.tensor [n, u, v] (torch.bool), mask ids are stable
     """
     s_size, t_size = LF.shape[:2]
-    n = coarse_masks.shape[0]
-    for s in range(s_size):
-        for t in range(t_size):
-            if s == s_size // 2 and t == t_size // 2:
-                continue
-            coarse_masks_st = torch.clone(coarse_masks[:, s, t, :, :])
-            image_predictor.set_image(LF[s, t])
-            point_prompts_st = point_prompts[:, s, t]
-            box_prompts_st = box_prompts[:, s, t]
-            for segment_i, (point_prompts_i, box_prompts_i) in enumerate(
-                zip(point_prompts_st, box_prompts_st)
-            ):
-                point_prompts_i = point_prompts_i[None]
-                if point_prompts_i.sum() <= 1e-6:
-                    continue
-                labels = torch.ones(point_prompts_i.shape[0])
-                fine_segment_result, _, _ = image_predictor.predict(
-                    point_coords=point_prompts_i,
-                    point_labels=labels,
-                    box=box_prompts_i,
-                    multimask_output=True,
-                )
-                fine_segment_result = torch.tensor(
-                    fine_segment_result, dtype=torch.bool
-                ).cuda()
-                ious = masks_iou(fine_segment_result, coarse_masks_st[segment_i])
-                if ious.max() > CONFIG["iou-thresh"]:
-                    match_idx = torch.argmax(ious)
-                    coarse_masks[segment_i, s, t] = fine_segment_result[
-                        match_idx
-                    ]  # replacing coarse masks with fine ones
-    return coarse_masks
+    if anchors is None:
+        anchors = torch.ones((s_size, t_size), dtype=torch.bool)
+    if stats is not None:
+        stats.update({"encoder_calls": 0, "decoder_calls": 0})
+    sources = {
+        (s, t): get_nearest_anchor(anchors, s, t)
+        for s in range(s_size)
+        for t in range(t_size)
+        if not anchors[s, t]
+    }
+    anchor_results = {}
+
+    def get_anchor_result(s, t):
+        if (s, t) in anchor_results:
+            return anchor_results[(s, t)]
+        if s == s_size // 2 and t == t_size // 2:
+            result = coarse_masks[:, s, t].to(DEVICE)
+        else:
+            result = refine_subview(
+                LF[s, t],
+                image_predictor,
+                coarse_masks[:, s, t].to(DEVICE),
+                point_prompts[:, s, t],
+                box_prompts[:, s, t],
+                None if skip_masks is None else skip_masks[:, s, t],
+                stats,
+            )
+        if (s, t) in sources.values():
+            anchor_results[(s, t)] = result
+        return result
+
+    ring_order = get_ring_order(s_size, t_size)
+    last_use = {}  # anchor -> ring position of the last subview reading it
+    for position, (s, t) in enumerate(ring_order):
+        last_use[sources.get((s, t), (s, t))] = position
+    for position, (s, t) in enumerate(ring_order):
+        if anchors[s, t]:
+            yield s, t, get_anchor_result(s, t)
+        else:
+            s_anchor, t_anchor = sources[(s, t)]
+            yield s, t, warp_anchor_masks(
+                get_anchor_result(s_anchor, t_anchor),
+                mask_disparities,
+                s - s_anchor,
+                t - t_anchor,
+            )
+        source = sources.get((s, t), (s, t))
+        if last_use[source] == position:
+            anchor_results.pop(source, None)
 
 
 def filter_final_masks(masks, relative_area_min=CONFIG["relative-min-area"]):
@@ -209,16 +532,219 @@ def filter_final_masks(masks, relative_area_min=CONFIG["relative-min-area"]):
     return torch.stack(result)
 
 
-def sam_fast_LF_segmentation(mask_predictor, LF, visualize=False):
+def get_mask_chunk_size(LF, memory_budget_gb=CONFIG["memory-budget-gb"]):
+    """
+    Number of masks whose [s, t, u, v] tensors fit into the memory budget:
+    bool coarse masks, their float16 semantic weights and bool prompt selections
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    returns: int
+    """
+    bytes_per_mask = math.prod(LF.shape[:4]) * (1 + 2 + 1)
+    return max(1, int(memory_budget_gb * 2**30 // bytes_per_mask))
+
+
+def get_spill_storage(
+    shape, spill=CONFIG["spill"], spill_folder=CONFIG["spill-folder"]
+):
+    """
+    Allocate host storage for finished mask chunks
+    spill: str, "host" for pinned memory, "disk" for a file-backed tensor, each
+           allocation has its own file, removed once the tensor is freed
+    returns: torch.tensor shape (torch.bool)
+    """
+    if spill == "host" or math.prod(shape) == 0:
+        return torch.zeros(
+            shape, dtype=torch.bool, pin_memory=torch.cuda.is_available()
+        )
+    if spill == "disk":
+        os.makedirs(spill_folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=spill_folder, suffix=".bin", delete=False
+        ) as f:
+            f.truncate(math.prod(shape))
+        try:
+            storage = torch.from_file(
+                f.name, shared=True, size=math.prod(shape), dtype=torch.bool
+            )
+        finally:
+            os.remove(f.name)  # the mapping keeps the data until the tensor is freed
+        return storage.reshape(shape)
+    raise ValueError(f"{spill} is not a valid spill option")
+
+
+def get_coarse_stage(
+    LF,
+    masks_central,
+    mask_disparities,
+    disparities,
+    anchors,
+    subview_embeddings=None,
+    disparity_variances=None,
+    coarse_masks=None,
+    use_semantic=CONFIG["use-semantic"],
+    sim_thresh=CONFIG["sim-thresh"],
+):
+    """
+    Coarse matching, semantic weighting and prompts for a chunk of central masks
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    masks_central: torch.tensor [n, u, v] (torch.bool)
+    mask_disparities: torch.tensor [n] (torch.float32)
+    disparities: torch.tensor [u, v] (torch.float32)
+    anchors: torch.tensor [s, t] (torch.bool)
+    subview_embeddings: torch.tensor [s, t, 64, 64, 256], required with use-semantic
+    disparity_variances: torch.tensor [n] (torch.float32), enables early exit
+    coarse_masks: torch.tensor [n, s, t, u, v] (torch.bool), skips coarse matching
+    returns: torch.tensor [n, s, t, u, v] (torch.bool),
+             torch.tensor [n, s, t, 2] (torch.float),
+             torch.tensor [n, s, t, 4] (torch.float),
+             torch.tensor [n, s, t] (torch.bool) or None
+    """
+    if coarse_masks is None:
+        coarse_masks = get_coarse_matching(
+            LF, masks_central, mask_disparities, disparities
+        )
+    weighted_coarse_masks = None
+    if use_semantic:
+        weighted_coarse_masks = refine_coarse_masks_semantic(
+            subview_embeddings, coarse_masks, anchors, sim_thresh
+        )
+        point_prompts, box_prompts = get_prompts_for_masks(
+            weighted_coarse_masks, anchors, use_semantic
+        )
+    else:
+        point_prompts, box_prompts = get_prompts_for_masks(
+            coarse_masks, anchors, use_semantic
+        )
+    skip_masks = None
+    if disparity_variances is not None:
+        skip_masks = get_confident_masks(
+            coarse_masks, weighted_coarse_masks, disparity_variances
+        )
+    del weighted_coarse_masks
+    return coarse_masks, point_prompts, box_prompts, skip_masks
+
+
+def _stage_key(store, stage, upstream=(), config=None):
+    return None if store is None else store.key(stage, upstream, config)
+
+
+def _load_stage(store, stage, key):
+    return None if store is None else store.load(stage, key)
+
+
+def _save_stage(store, stage, key, value):
+    if store is not None:
+        store.save(stage, key, value)
+
+
+def get_disparities_stage(LF, store=None, key=None):
+    """
+    Estimate central subview disparities, reusing the stored artifact if present
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    store: ArtifactStore
+    key: str, stage key, computed from LF if not given
+    returns: np.array [u, v] (np.float32)
+    """
+    if store is not None and key is None:
+        key = _stage_key(store, "disparities", [get_scene_key(LF)])
+    disparities = _load_stage(store, "disparities", key)
+    if disparities is None:
+        print("get_LF_disparities...", end="")
+        disparities = get_LF_disparities(LF)
+        print(f"done, shape: {disparities.shape}")
+        _save_stage(store, "disparities", key, disparities)
+    return disparities
+
+
+def sam_fast_LF_segmentation_stream(
+    mask_predictor,
+    LF,
+    stats=None,
+    subview_embeddings=None,
+    store=None,
+    disparities=None,
+    masks_central=None,
+    state=None,
+    scene_key=None,
+):
+    """
+    Segment LF, yielding subview results ring by ring from the central subview
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    stats: dict, filled with mask generation and refinement statistics
+    store: ArtifactStore, stage outputs are reused from it and saved to it
+    disparities: np.array [u, v] (np.float32), precomputed get_LF_disparities(LF)
+    masks_central: torch.tensor [n, u, v] (torch.bool), skips mask generation
+    state: dict, filled with the central masks, disparities and subview
+           embeddings of this LF for reuse in the next frame of a sequence
+    scene_key: str, precomputed get_scene_key(LF)
+    yields: int, int, torch.tensor [n, u, v] (torch.bool), mask ids are stable
+    """
     s_central, t_central = LF.shape[0] // 2, LF.shape[1] // 2
+    if store is not None and scene_key is None:
+        scene_key = get_scene_key(LF)
+    stage_times = {}
+    stage_start = time()
+
+    disparities_key = _stage_key(store, "disparities", [scene_key])
+    if disparities is None:
+        disparities = get_disparities_stage(LF, store, disparities_key)
+    disparities = torch.tensor(disparities).to(DEVICE)
+    stage_times["disparities"] = time() - stage_start
+    stage_start = time()
 
-    print("generate_image_masks...", end="")
-    masks_central = generate_image_masks(mask_predictor, LF[s_central, t_central])
-    print(f"done, shape: {masks_central.shape}")
+    if state is not None:
+        state["disparities"] = disparities.cpu().numpy()
+    if masks_central is not None:
+        central_key = _stage_key(
+            store,
+            "central_masks",
+            [get_scene_key(masks_central.cpu().numpy())],
+        )
+        central_stage = (masks_central, {"n_prompts": 0, "coverage": None})
+    else:
+        central_key = _stage_key(
+            store,
+            "central_masks",
+            [scene_key, disparities_key],
+            {**SAM2_CONFIG, "sam-version": CONFIG["sam-version"]},
+        )
+        central_stage = _load_stage(store, "central_masks", central_key)
+    if central_stage is None:
+        print("generate_image_masks...", end="")
+        generation_stats = {}
+        masks_central = generate_image_masks(
+            mask_predictor,
+            LF[s_central, t_central],
+            disparities.cpu().numpy(),
+            generation_stats,
+        )
+        print(
+            f"done, shape: {masks_central.shape}, "
+            f"prompts: {generation_stats['n_prompts']}, "
+            f"coverage: {generation_stats['coverage']:.3f}"
+        )
+        _save_stage(
+            store, "central_masks", central_key, (masks_central.cpu(), generation_stats)
+        )
+    else:
+        masks_central, generation_stats = central_stage
+        masks_central = masks_central.to(DEVICE)
+    del central_stage
+    generation_stats = dict(generation_stats)
+    if CONFIG["prune-masks"]:
+        keep = get_pruned_masks(masks_central)
+        generation_stats["n_pruned"] = (~keep).sum().item()
+        masks_central = masks_central[keep]
+        del keep
+        print(
+            f"pruned {generation_stats['n_pruned']} masks, "
+            f"{masks_central.shape[0]} left"
+        )
+    if state is not None:
+        state["masks_central"] = masks_central
 
-    print("get_LF_disparities...", end="")
-    disparities = torch.tensor(get_LF_disparities(LF)).cuda()
-    print(f"done, shape: {disparities.shape}")
+    stage_times["central_masks"] = time() - stage_start
+    stage_start = time()
 
     print("get_mask_disparities...", end="")
     mask_disparities = get_mask_disparities(masks_central, disparities)
@@ -227,31 +753,163 @@ def sam_fast_LF_segmentation(mask_predictor, LF, visualize=False):
     mask_disparities = mask_disparities[mask_depth_order]
     del mask_depth_order
     print(f"done, shape: {mask_disparities.shape}")
-    print("get_coarse_matching...", end="")
-    coarse_matched_masks = get_coarse_matching(
-        LF, masks_central, mask_disparities, disparities
+    anchors = get_anchor_subviews(LF.shape[0], LF.shape[1])
+    prompts_config = {
+        key: CONFIG[key]
+        for key in CONFIG
+        if key in ["sim-thresh", "use-semantic", "anchor-mode", "anchor-stride"]
+        or key.startswith("early-exit")
+    }
+    prune_config = {key: CONFIG[key] for key in CONFIG if key.startswith("prune")}
+    coarse_key = _stage_key(
+        store, "coarse_masks", [central_key, disparities_key], prune_config
     )
-    print(f"done, shape: {coarse_matched_masks.shape}")
-    del mask_disparities
-    del masks_central
-    del disparities
-    if CONFIG["use-semantic"]:
-        subview_embeddings = get_subview_embeddings(mask_predictor.predictor, LF)
-        weighted_coarse_masks = refine_coarse_masks_semantic(
-            subview_embeddings, coarse_matched_masks
+    prompts_key = _stage_key(store, "prompts", [coarse_key], prompts_config)
+    refined_key = _stage_key(
+        store, "refined_masks", [prompts_key], {"iou-thresh": CONFIG["iou-thresh"]}
+    )
+    refined_stage = _load_stage(store, "refined_masks", refined_key)
+    if refined_stage is not None:
+        refined_masks, refinement_stats = refined_stage
+        for s, t in get_ring_order(LF.shape[0], LF.shape[1]):
+            yield s, t, refined_masks[:, s, t].to(DEVICE)
+        if stats is not None:
+            stats.update(refinement_stats)
+            stats["stage_times"] = stage_times  # the stored ones are from another run
+        return
+
+    coarse_matched_masks = _load_stage(store, "coarse_masks", coarse_key)
+    prompts_stage = _load_stage(store, "prompts", prompts_key)
+    if coarse_matched_masks is None or prompts_stage is None:
+        disparity_variances = None
+        if CONFIG["early-exit"]:
+            disparity_variances = get_mask_disparity_variances(
+                masks_central, disparities
+            )
+        if CONFIG["use-semantic"] and subview_embeddings is None:
+            subview_embeddings = get_subview_embeddings(
+                mask_predictor.predictor, LF, anchors
+            )
+        if state is not None:
+            state["subview_embeddings"] = subview_embeddings
+        coarse_loaded = coarse_matched_masks is not None
+        if not coarse_loaded:
+            coarse_matched_masks = get_spill_storage(
+                (masks_central.shape[0], *LF.shape[:4])
+            )
+        chunk_size = get_mask_chunk_size(LF)
+        print(f"get_coarse_matching, chunks of {chunk_size} masks...", end="")
+        point_prompts, box_prompts, skip_masks = [], [], []
+        for chunk_start in range(0, masks_central.shape[0], chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            coarse_chunk, point_prompts_chunk, box_prompts_chunk, skip_chunk = (
+                get_coarse_stage(
+                    LF,
+                    masks_central[chunk],
+                    mask_disparities[chunk],
+                    disparities,
+                    anchors,
+                    subview_embeddings,
+                    (
+                        None
+                        if disparity_variances is None
+                        else disparity_variances[chunk]
+                    ),
+                    coarse_matched_masks[chunk].to(DEVICE) if coarse_loaded else None,
+                )
+            )
+            if not coarse_loaded:
+                coarse_matched_masks[chunk] = coarse_chunk.cpu()  # spill the chunk
+            del coarse_chunk
+            point_prompts.append(point_prompts_chunk)
+            box_prompts.append(box_prompts_chunk)
+            skip_masks.append(skip_chunk)
+        print(f"done, shape: {coarse_matched_masks.shape}")
+        if masks_central.shape[0] == 0:  # no chunks, e.g. every mask was pruned
+            point_prompts.append(torch.zeros((0, *LF.shape[:2], 2)).to(DEVICE))
+            box_prompts.append(torch.zeros((0, *LF.shape[:2], 4)).to(DEVICE))
+            skip_masks.append(
+                torch.zeros((0, *LF.shape[:2]), dtype=torch.bool).to(DEVICE)
+            )
+        point_prompts = torch.cat(point_prompts)
+        box_prompts = torch.cat(box_prompts)
+        skip_masks = torch.cat(skip_masks) if CONFIG["early-exit"] else None
+        if not coarse_loaded:
+            _save_stage(store, "coarse_masks", coarse_key, coarse_matched_masks)
+        _save_stage(
+            store, "prompts", prompts_key, (point_prompts, box_prompts, skip_masks)
         )
-        del subview_embeddings
-        point_prompts, box_prompts = get_prompts_for_masks(weighted_coarse_masks)
-        del weighted_coarse_masks
     else:
-        point_prompts, box_prompts = get_prompts_for_masks(coarse_matched_masks)
-    print("get_fine_matching...", end="")
-    refined_matched_masks = get_refined_matching(
-        LF, mask_predictor.predictor, coarse_matched_masks, point_prompts, box_prompts
+        point_prompts, box_prompts, skip_masks = prompts_stage
+    del prompts_stage
+    del masks_central
+    del disparities
+    del subview_embeddings
+    stage_times["coarse_masks"] = time() - stage_start
+    stage_start = time()
+    refinement_stats = dict(generation_stats)
+    refined_masks = None
+    if store is not None:
+        refined_masks = torch.zeros(coarse_matched_masks.shape, dtype=torch.bool)
+    print("get_fine_matching...")
+    for s, t, refined_masks_st in iterate_refined_matching(
+        LF,
+        mask_predictor.predictor,
+        coarse_matched_masks,
+        point_prompts,
+        box_prompts,
+        anchors,
+        mask_disparities,
+        skip_masks,
+        refinement_stats,
+    ):
+        if refined_masks is not None:
+            refined_masks[:, s, t] = refined_masks_st.cpu()
+        yield s, t, refined_masks_st
+    stage_times["refined_masks"] = time() - stage_start
+    refinement_stats["stage_times"] = stage_times
+    print(
+        f"fine matching done, "
+        f"refined subviews: {anchors.sum().item() - 1}/{anchors.numel() - 1}"
     )
-    print(f"done, shape: {refined_matched_masks.shape}")
-    del mask_predictor
+    del mask_disparities
     del coarse_matched_masks
+    if skip_masks is not None:
+        n_candidates = (
+            (point_prompts.sum(dim=3) > 1e-6) & anchors.to(DEVICE)[None]
+        ).sum().item()
+        n_skipped = (
+            skip_masks & (point_prompts.sum(dim=3) > 1e-6) & anchors.to(DEVICE)[None]
+        ).sum().item()
+        refinement_stats["skip_ratio"] = n_skipped / max(n_candidates, 1)
+        refinement_stats["encoder_calls_saved"] = 1 - refinement_stats[
+            "encoder_calls"
+        ] / max(anchors.sum().item() - 1, 1)
+        print(
+            f"early exit: skipped {n_skipped}/{n_candidates} refinements, "
+            f"saved {refinement_stats['encoder_calls_saved']:.1%} encoder calls"
+        )
+    del skip_masks
+    _save_stage(store, "refined_masks", refined_key, (refined_masks, refinement_stats))
+    if stats is not None:
+        stats.update(refinement_stats)
+
+
+def sam_fast_LF_segmentation(
+    mask_predictor, LF, visualize=False, stats=None, subview_embeddings=None
+):
+    s_size, t_size, u_size, v_size = LF.shape[:4]
+    refined_matched_masks = None
+    for s, t, refined_masks_st in sam_fast_LF_segmentation_stream(
+        mask_predictor, LF, stats, subview_embeddings
+    ):
+        if refined_matched_masks is None:
+            refined_matched_masks = torch.zeros(
+                (refined_masks_st.shape[0], s_size, t_size, u_size, v_size),
+                dtype=torch.bool,
+            ).to(DEVICE)
+        refined_matched_masks[:, s, t] = refined_masks_st
+    del mask_predictor
     if visualize:
         print("visualizing segments...")
         refined_segments = masks_to_segments(refined_matched_masks)
@@ -259,6 +917,138 @@ def sam_fast_LF_segmentation(mask_predictor, LF, visualize=False):
     return refined_matched_masks
 
 
+def sam_fast_LF_segmentation_to_host(mask_predictor, LF, stats=None, **kwargs):
+    """
+    Consume the segmentation stream into host memory subview by subview
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    kwargs: passed to sam_fast_LF_segmentation_stream
+    returns: torch.tensor [n, s, t, u, v] (torch.bool),
+             torch.tensor [s, t, u, v] (torch.long)
+    """
+    s_size, t_size, u_size, v_size = LF.shape[:4]
+    result_masks = None
+    for s, t, masks_st in sam_fast_LF_segmentation_stream(
+        mask_predictor, LF, stats=stats, **kwargs
+    ):
+        if result_masks is None:  # the central subview comes first
+            result_masks = torch.zeros(
+                (masks_st.shape[0], s_size, t_size, u_size, v_size),
+                dtype=torch.bool,
+            )
+            result_segments = torch.zeros(
+                (s_size, t_size, u_size, v_size), dtype=torch.long
+            )
+            segment_order = get_segment_order(masks_st)
+        result_masks[:, s, t] = masks_st.cpu()
+        result_segments[s, t] = subview_masks_to_segments(
+            masks_st, segment_order
+        ).cpu()
+        del masks_st
+    return result_masks, result_segments
+
+
+def get_uncovered_point_grid(
+    uncovered, points_per_side=SAM2_CONFIG["points-per-side"]
+):
+    """
+    Regular point prompt grid restricted to uncovered pixels
+    uncovered: torch.tensor [u, v] (torch.bool)
+    returns: np.array [k, 2] (np.float), (x, y) normalized to [0, 1]
+    """
+    u, v = uncovered.shape
+    coords = (torch.arange(points_per_side) + 0.5) / points_per_side
+    ys, xs = torch.meshgrid(coords, coords, indexing="ij")
+    grid = torch.stack([xs.reshape(-1), ys.reshape(-1)], dim=1)
+    keep = uncovered.cpu()[(grid[:, 1] * u).long(), (grid[:, 0] * v).long()]
+    return grid[keep].numpy()
+
+
+def seed_frame_masks(
+    mask_predictor,
+    image,
+    prev_masks_central,
+    new_mask_overlap=CONFIG["sequence-new-mask-overlap"],
+    min_uncovered=CONFIG["sequence-min-uncovered"],
+):
+    """
+    Central masks of a sequence frame: previous frame masks re-predicted from their
+    boxes, plus automatic masks generated only in newly uncovered regions
+    image: np.array [u, v, 3] (np.uint8)
+    prev_masks_central: torch.tensor [n, u, v] (torch.bool)
+    returns: torch.tensor [m, u, v] (torch.bool), int number of new masks
+    """
+    prev_masks_central = prev_masks_central[prev_masks_central.any(dim=(1, 2))]
+    if prev_masks_central.shape[0] == 0:
+        new_masks = generate_image_masks(mask_predictor, image)
+        return new_masks, new_masks.shape[0]
+    seeded_masks = get_image_masks_from_boxes(
+        mask_predictor.predictor,
+        masks_to_boxes(prev_masks_central).cpu().numpy(),
+        image,
+    )
+    seeded_masks = torch.tensor(seeded_masks).to(DEVICE).bool().reshape(
+        -1, *image.shape[:2]
+    )
+    seeded_masks = seeded_masks[seeded_masks.any(dim=(1, 2))]
+    uncovered = ~seeded_masks.any(dim=0)
+    if uncovered.float().mean() < min_uncovered:
+        return seeded_masks, 0
+    point_grid = get_uncovered_point_grid(uncovered)
+    if point_grid.shape[0] == 0:
+        return seeded_masks, 0
+    new_masks = generate_image_masks(mask_predictor, image, point_grid=point_grid)
+    areas = new_masks.sum(dim=(1, 2)).float().clamp(min=1)
+    overlap = (new_masks & ~uncovered[None]).sum(dim=(1, 2)).float() / areas
+    new_masks = new_masks[overlap <= new_mask_overlap]
+    return torch.cat([seeded_masks, new_masks]), new_masks.shape[0]
+
+
+def sam_fast_LF_segmentation_sequence(
+    mask_predictor,
+    LFs,
+    static_thresh=CONFIG["sequence-static-thresh"],
+):
+    """
+    Segment consecutive LF frames, seeding each frame from the previous one.
+    Disparities and subview embeddings are reused while the central view barely
+    changes from the frame they were computed on. Mask ids are not kept between
+    frames.
+    LFs: iterable of np.array [s, t, u, v, 3] (np.uint8)
+    yields: torch.tensor [n, s, t, u, v] (torch.bool),
+            torch.tensor [s, t, u, v] (torch.long), dict of frame statistics
+    """
+    state = {}
+    for LF in LFs:
+        s_central, t_central = LF.shape[0] // 2, LF.shape[1] // 2
+        frame_stats = {}
+        kwargs = {}
+        if "reference_central" in state:
+            central_change = np.abs(
+                LF[s_central, t_central].astype(np.float32)
+                - state["reference_central"].astype(np.float32)
+            ).mean()
+            frame_stats["central_change"] = float(central_change)
+            frame_stats["static"] = bool(central_change < static_thresh)
+            if frame_stats["static"]:
+                kwargs["disparities"] = state["disparities"]
+                kwargs["subview_embeddings"] = state.get("subview_embeddings")
+            kwargs["masks_central"], frame_stats["n_new_masks"] = seed_frame_masks(
+                mask_predictor, LF[s_central, t_central], state["masks_central"]
+            )
+        # central view of the frame the reused disparities and embeddings are from
+        reference_central = (
+            state["reference_central"]
+            if frame_stats.get("static")
+            else LF[s_central, t_central]
+        )
+        state = {"reference_central": reference_central}
+        result_masks, result_segments = sam_fast_LF_segmentation_to_host(
+            mask_predictor, LF, stats=frame_stats, state=state, **kwargs
+        )
+        del kwargs
+        yield result_masks, result_segments, frame_stats
+
+
 def sam_fast_LF_segmentation_dataset(
     dataset,
     save_folder,
@@ -270,43 +1060,129 @@ def sam_fast_LF_segmentation_dataset(
         if CONFIG["sam-version"] == 2
         else get_sam_1_auto_mask_predictor()
     )
+    store = (
+        ArtifactStore(f"{save_folder}/artifacts")
+        if CONFIG["stage-checkpoints"]
+        else None
+    )
     time_path = f"{save_folder}/computation_times.pt"
+    stats_path = f"{save_folder}/refinement_stats.pt"
     computation_times = []
+    refinement_stats = []
     if continue_progress and os.path.exists(time_path):
         computation_times = torch.load(time_path).tolist()
-    for i, (LF, _, _) in enumerate(dataset):
-        masks_path = f"{save_folder}/{str(i).zfill(4)}_masks.pt"
-        segments_path = f"{save_folder}/{str(i).zfill(4)}_segments.pt"
-        if (
-            all([os.path.exists(path) for path in [masks_path, segments_path]])
-            and continue_progress
-        ):
-            continue
+    if continue_progress and os.path.exists(stats_path):
+        refinement_stats = torch.load(stats_path)
+
+    def get_paths(i):
+        return (
+            f"{save_folder}/{str(i).zfill(4)}_masks.pt",
+            f"{save_folder}/{str(i).zfill(4)}_segments.pt",
+        )
+
+    def load_scene(i):
+        LF, _, _ = dataset[i]
+        return i, LF
+
+    def estimate_disparities(item):
+        i, LF = item
+        scene_key = None if store is None else get_scene_key(LF)
+        disparities_key = _stage_key(store, "disparities", [scene_key])
+        return i, LF, scene_key, get_disparities_stage(LF, store, disparities_key)
+
+    def segment_scene(item):
+        i, LF, scene_key, disparities = item
         print(f"segmenting lf {i}")
-        start_time = time()
-        result_masks = sam_fast_LF_segmentation(
+        scene_stats = {}
+        result_masks, result_segments = sam_fast_LF_segmentation_to_host(
             mask_predictor,
             LF,
-            visualize=visualize,
-        )
-        end_time = time()
-        computation_times.append(
-            (end_time - start_time)
-            / float(
-                result_masks.shape[0] * result_masks.shape[1] * result_masks.shape[2]
-            )
+            stats=scene_stats,
+            store=store,
+            disparities=disparities,
+            scene_key=scene_key,
         )
-        result_segments = masks_to_segments(result_masks)
+        if CONFIG["postprocess-components"]:
+            result_segments = remap_labels(
+                result_segments.to(DEVICE),
+                CONFIG["component-connectivity"],
+                CONFIG["component-min-avg-area"],
+            ).cpu()
+        return i, result_masks, result_segments, scene_stats
+
+    def write_scene(item):
+        i, result_masks, result_segments, scene_stats = item
+        if visualize:
+            print("visualizing segments...")
+            visualize_segmentation_mask(result_segments.numpy())
+        masks_path, segments_path = get_paths(i)
         torch.save(result_masks, masks_path)
         torch.save(result_segments, segments_path)
-        del result_masks
-        del result_segments
+        return i, result_masks.shape, scene_stats
+
+    indices = [
+        i
+        for i in range(len(dataset))
+        if not (
+            continue_progress
+            and all([os.path.exists(path) for path in get_paths(i)])
+        )
+    ]
+    executor = StagedExecutor(
+        [
+            ("load", load_scene, 1),
+            ("disparities", estimate_disparities, CONFIG["pipeline-disparity-workers"]),
+            ("segment", segment_scene, 1),
+            ("write", write_scene, 1),
+        ],
+        queue_size=CONFIG["pipeline-queue-size"],
+        concurrent=CONFIG["pipeline"],
+    )
+    for index, result, timings in executor.run(indices):
+        if isinstance(result, StageError):
+            if not isinstance(result.error, torch.cuda.OutOfMemoryError):
+                executor.close()
+                print(result.traceback)
+                raise result.error
+            print(f"lf {indices[index]} does not fit into memory-budget-gb, skipping")
+            del result
+            torch.cuda.empty_cache()
+            continue
+        _, masks_shape, scene_stats = result
+        n_mask_subviews = masks_shape[0] * masks_shape[1] * masks_shape[2]
+        computation_times.append(
+            (timings["disparities"] + timings["segment"]) / float(n_mask_subviews)
+            if n_mask_subviews > 0
+            else float("nan")  # no masks, e.g. all pruned
+        )
         torch.save(
             torch.tensor(computation_times),
             time_path,
         )
+        refinement_stats.append(scene_stats)
+        torch.save(refinement_stats, stats_path)
+        stage_timings = dict(timings)
+        for name, seconds in scene_stats.get("stage_times", {}).items():
+            stage_timings[f"segment.{name}"] = seconds
+        append_timing_record(
+            save_folder,
+            make_timing_record(
+                get_scene_name(dataset, indices[index]),
+                stage_timings,
+                {"method": CONFIG, "sam2": SAM2_CONFIG},
+                "ours",
+            ),
+        )
+    print(
+        "stage utilization: "
+        + ", ".join(
+            f"{name}: {value:.1%}" for name, value in executor.utilization().items()
+        )
+    )
 
 
 if __name__ == "__main__":
+    from data import UrbanLFSynDataset
+
     dataset = UrbanLFSynDataset("UrbanLF_Syn/val")
     sam_fast_LF_segmentation_dataset(dataset, "test_result", visualize=True)
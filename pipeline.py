@@ -0,0 +1,158 @@
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import time
+import traceback
+
+
+class StageError:
+    """
+    A failed stage. The traceback is kept as text only, as its frames would keep
+    the failed item's tensors alive
+    """
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.traceback = "".join(
+            traceback.format_exception(type(error), error, error.__traceback__)
+        )
+        chained = error
+        while chained is not None:
+            chained.__traceback__ = None
+            chained = chained.__cause__ or chained.__context__
+        self.error = error
+
+    def __repr__(self):
+        return f"{self.stage} failed: {self.error!r}"
+
+
+class StagedExecutor:
+    """
+    Runs items through a chain of stages. With concurrent=True every stage has its
+    own worker threads and a bounded input queue, so consecutive items occupy
+    different stages at the same time. Results are returned in input order.
+    stages: list of (name, function, n_workers)
+    """
+
+    _stop = object()
+
+    def __init__(self, stages, queue_size=2, concurrent=True):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.concurrent = concurrent
+        self.lock = Lock()
+        self.busy_time = {name: 0.0 for name, _, _ in stages}
+        self.wall_time = 0.0
+        self._stopping = Event()
+        self._queues = None
+
+    def _run_stage(self, name, function, value, timings):
+        if isinstance(value, StageError):
+            return value
+        start_time = time()
+        try:
+            value = function(value)
+        except Exception as e:
+            value = StageError(name, e)
+        timings[name] = time() - start_time
+        with self.lock:
+            self.busy_time[name] += timings[name]
+        return value
+
+    def _worker(self, name, function, queue_in, queue_out, n_alive):
+        while True:
+            item = queue_in.get()
+            if item is self._stop:
+                with self.lock:
+                    n_alive[0] -= 1
+                    last = n_alive[0] == 0
+                if last:
+                    queue_out.put(self._stop)
+                else:
+                    queue_in.put(self._stop)  # let the other workers see it
+                return
+            if self._stopping.is_set():
+                continue  # drop items in flight after close
+            index, value, timings = item
+            value = self._run_stage(name, function, value, timings)
+            queue_out.put((index, value, timings))
+
+    def _feed(self, items, queue_out):
+        for index, item in enumerate(items):
+            if self._stopping.is_set():
+                break
+            queue_out.put((index, item, {}))
+        queue_out.put(self._stop)
+
+    def run(self, items):
+        """
+        items: iterable of stage inputs
+        yields: (int, output or StageError, dict stage name -> seconds)
+        """
+        start_time = time()
+        if not self.concurrent:
+            for index, value in enumerate(items):
+                timings = {}
+                for name, function, _ in self.stages:
+                    value = self._run_stage(name, function, value, timings)
+                self.wall_time = time() - start_time
+                yield index, value, timings
+            return
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        self._stopping.clear()
+        self._queues = queues
+        threads = [Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for stage_i, (name, function, n_workers) in enumerate(self.stages):
+            n_alive = [n_workers]
+            for _ in range(n_workers):
+                threads.append(
+                    Thread(
+                        target=self._worker,
+                        args=(
+                            name,
+                            function,
+                            queues[stage_i],
+                            queues[stage_i + 1],
+                            n_alive,
+                        ),
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        pending = {}
+        next_index = 0
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is self._stop:
+                    self._queues = None
+                    break
+                pending[item[0]] = item
+                while next_index in pending:
+                    self.wall_time = time() - start_time
+                    yield pending.pop(next_index)
+                    next_index += 1
+        finally:
+            self.close()
+        self.wall_time = time() - start_time
+
+    def close(self):
+        """
+        Stop feeding items and wait until the workers have dropped the ones in
+        flight, e.g. before re-raising a StageError
+        """
+        self._stopping.set()
+        if self._queues is not None:
+            while self._queues[-1].get() is not self._stop:
+                pass
+            self._queues = None
+
+    def utilization(self):
+        """
+        Fraction of wall time each stage's workers were busy
+        returns: dict, stage name -> float
+        """
+        return {
+            name: self.busy_time[name] / max(self.wall_time * n_workers, 1e-9)
+            for name, _, n_workers in self.stages
+        }
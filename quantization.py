@@ -0,0 +1,113 @@
+from time import time
+import argparse
+import numpy as np
+import torch
+import yaml
+from torchvision.ops import masks_to_boxes
+from sam2_functions import (
+    get_sam2_image_model,
+    get_image_predictor,
+    get_auto_mask_predictor,
+    generate_image_masks,
+    get_image_masks_from_boxes,
+)
+
+
+def get_encoder_throughput(image_predictor, images):
+    """
+    images: list of np.array [u, v, 3] (np.uint8)
+    returns: float, images per second
+    """
+    image_predictor.set_image(images[0])  # warm up
+    start_time = time()
+    for image in images:
+        image_predictor.set_image(image)
+    return len(images) / (time() - start_time)
+
+
+def get_paired_ious(masks_a, masks_b):
+    """
+    masks_a, masks_b: np.array [n, u, v]
+    returns: torch.tensor [n] (torch.float), IoU of masks_a[i] and masks_b[i]
+    """
+    masks_a = torch.tensor(masks_a).bool().reshape(masks_a.shape[0], -1)
+    masks_b = torch.tensor(masks_b).bool().reshape(masks_b.shape[0], -1)
+    intersection = (masks_a & masks_b).sum(dim=1)
+    union = (masks_a | masks_b).sum(dim=1)
+    return intersection / (union + 1e-9)
+
+
+def validate_quantization(dataset, n_scenes=3, n_subviews=4, max_masks=64, seed=0):
+    """
+    Compare the int8 model against fp32 on a sample of scenes: image encoder
+    throughput, and IoU of masks both decode from the same box prompts, taken
+    from fp32 automatic masks of the central subview
+    returns: dict
+    """
+    fp32_model = get_sam2_image_model("none")
+    fp32_predictor = get_image_predictor(fp32_model)
+    int8_predictor = get_image_predictor(get_sam2_image_model("int8"))
+    mask_generator = get_auto_mask_predictor(fp32_model)
+    rng = np.random.default_rng(seed)
+    fp32_throughputs, int8_throughputs, ious = [], [], []
+    for i in np.linspace(0, len(dataset) - 1, n_scenes).astype(int):
+        LF = dataset[i][0]
+        s_size, t_size = LF.shape[:2]
+        central = LF[s_size // 2, t_size // 2]
+        images = [central] + [
+            LF[st // t_size, st % t_size]
+            for st in rng.choice(s_size * t_size, n_subviews, replace=False)
+        ]
+        fp32_throughputs.append(get_encoder_throughput(fp32_predictor, images))
+        int8_throughputs.append(get_encoder_throughput(int8_predictor, images))
+        masks_central = generate_image_masks(mask_generator, central)[:max_masks]
+        if masks_central.shape[0] == 0:
+            continue
+        boxes = masks_to_boxes(masks_central).cpu().numpy()
+        for image in images:
+            ious.append(
+                get_paired_ious(
+                    get_image_masks_from_boxes(fp32_predictor, boxes, image),
+                    get_image_masks_from_boxes(int8_predictor, boxes, image),
+                )
+            )
+        print(
+            f"scene {i}: fp32 {fp32_throughputs[-1]:.2f} img/s, "
+            f"int8 {int8_throughputs[-1]:.2f} img/s, "
+            f"mean IoU {torch.cat(ious[-len(images):]).mean().item():.4f}"
+        )
+    fp32_throughput = float(np.mean(fp32_throughputs))
+    int8_throughput = float(np.mean(int8_throughputs))
+    report = {
+        "fp32-images-per-s": fp32_throughput,
+        "int8-images-per-s": int8_throughput,
+        "speedup": int8_throughput / fp32_throughput,
+        "n-masks": 0,
+    }
+    if len(ious) == 0:
+        print("no masks in the sampled scenes, IoU drift not measured")
+    else:
+        ious = torch.cat(ious)
+        report.update(
+            {
+                "mean-iou": ious.mean().item(),
+                "min-iou": ious.min().item(),
+                "below-0.9-iou": (ious < 0.9).float().mean().item(),
+                "n-masks": ious.shape[0],
+            }
+        )
+    print(report)
+    return report
+
+
+if __name__ == "__main__":
+    import data
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, default="UrbanLFSynDataset")
+    parser.add_argument("--n-scenes", type=int, default=3)
+    parser.add_argument("--output", type=str, default="quantization_report.yaml")
+    args = parser.parse_args()
+    report = validate_quantization(getattr(data, args.dataset)(), args.n_scenes)
+    with open(args.output, "w") as outfile:
+        yaml.dump(report, outfile, default_flow_style=False)
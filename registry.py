@@ -0,0 +1,27 @@
+import importlib
+
+NAME_TO_DATASET = {
+    "HCI": "data:HCIOldDataset",
+    "URBAN_SYN": "data:UrbanLFSynDataset",
+    "URBAN_REAL": "data:UrbanLFRealDataset",
+    "MMSPG": "data:MMSPG",
+}
+NAME_TO_METHOD = {
+    "baseline": "sam2_baseline:sam2_baseline_LF_segmentation_dataset",
+    "ours": "ours:sam_fast_LF_segmentation_dataset",
+}
+
+
+def load_registered(registry, name):
+    """
+    Import an object from the registry only when it is requested
+    registry: dict, name -> "module:attribute"
+    name: str, registry key or "module:attribute" for unregistered plugins
+    returns: (object, module)
+    """
+    path = registry.get(name, name if ":" in name else None)
+    if not path:
+        raise ValueError(f"{name} is not a valid name, options: {list(registry)}")
+    module_name, attribute = path.split(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute), module
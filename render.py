@@ -0,0 +1,177 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import numpy as np
+import imgviz
+import torch
+from PIL import Image
+from utils import lawnmower_indices, segment_boundaries
+
+
+def render_subview(
+    segments_st,
+    colormap,
+    image_st=None,
+    downsample=1,
+    only_boundaries=False,
+    out=None,
+):
+    """
+    Color one subview's segments, optionally over its image
+    segments_st: np.array or torch.tensor [u, v]
+    colormap: np.array [n_labels, 3] (np.uint8)
+    image_st: np.array [u, v, 3] (np.uint8)
+    out: np.array [u // downsample, v // downsample, 3] (np.uint8) to write into
+    returns: np.array [u // downsample, v // downsample, 3] (np.uint8)
+    """
+    if isinstance(segments_st, torch.Tensor):
+        segments_st = segments_st.cpu().numpy()
+    segments_st = segments_st[::downsample, ::downsample]
+    if out is None:
+        out = np.empty((*segments_st.shape, 3), dtype=np.uint8)
+    colors = colormap[segments_st]
+    if image_st is None:
+        base = np.zeros_like(colors)
+    else:
+        image_st = image_st[::downsample, ::downsample, :3]
+        base = image_st.mean(axis=-1, keepdims=True).astype(np.uint8)
+    if only_boundaries:
+        boundaries = segment_boundaries(torch.from_numpy(segments_st)).numpy()
+        out[:] = base
+        out[boundaries] = colors[boundaries]
+    elif image_st is None:
+        out[:] = colors
+    else:
+        out[:] = colors // 2 + base // 2  # same blend as imgviz.label2rgb
+    return out
+
+
+def render_LF(segments, LF=None, downsample=1, only_boundaries=False, order=None):
+    """
+    Render subviews one at a time, the full RGB light field is never allocated
+    segments: np.array or torch.tensor [s, t, u, v]
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    order: list of [s, t], defaults to row-major
+    yields: (s, t, np.array [u // downsample, v // downsample, 3] (np.uint8))
+    """
+    s_size, t_size = segments.shape[:2]
+    colormap = imgviz.label_colormap(int(segments.max()) + 1)
+    if order is None:
+        order = [[s, t] for s in range(s_size) for t in range(t_size)]
+    buffer = None
+    for s, t in order:
+        buffer = render_subview(
+            segments[s, t],
+            colormap,
+            None if LF is None else LF[s, t],
+            downsample,
+            only_boundaries,
+            buffer,
+        )
+        yield s, t, buffer
+
+
+def save_mosaic(segments, filename, LF=None, downsample=1, only_boundaries=False):
+    """
+    Write an [s * u, t * v] mosaic PNG, filled subview by subview
+    """
+    s_size, t_size, u, v = segments.shape[:4]
+    u, v = len(range(0, u, downsample)), len(range(0, v, downsample))
+    mosaic = np.empty((s_size * u, t_size * v, 3), dtype=np.uint8)
+    for s, t, subview in render_LF(segments, LF, downsample, only_boundaries):
+        mosaic[s * u : (s + 1) * u, t * v : (t + 1) * v] = subview
+    Image.fromarray(mosaic).save(filename)
+
+
+def save_subviews(segments, folder, LF=None, downsample=1, only_boundaries=False):
+    """
+    Write one PNG per subview to folder/{s}_{t}.png
+    """
+    os.makedirs(folder, exist_ok=True)
+    for s, t, subview in render_LF(segments, LF, downsample, only_boundaries):
+        Image.fromarray(subview).save(f"{folder}/{s}_{t}.png")
+
+
+def save_video(
+    segments, filename, LF=None, downsample=1, only_boundaries=False, fps=10
+):
+    """
+    Encode subviews in lawnmower order into a video
+    """
+    import cv2
+
+    writer = None
+    order = lawnmower_indices(*segments.shape[:2])
+    for _, _, subview in render_LF(segments, LF, downsample, only_boundaries, order):
+        if writer is None:
+            writer = cv2.VideoWriter(
+                filename,
+                cv2.VideoWriter_fourcc(*"mp4v"),
+                fps,
+                (subview.shape[1], subview.shape[0]),
+            )
+        writer.write(subview[:, :, ::-1])  # opencv expects BGR
+    writer.release()
+
+
+def render_segments_file(segments_path, mode, downsample=1, only_boundaries=False):
+    """
+    Render a saved [s, t, u, v] segments tensor next to it
+    mode: str, [mosaic, subviews, video]
+    returns: str, output path
+    """
+    segments = torch.load(segments_path, map_location="cpu")
+    prefix = segments_path[: -len(".pt")]
+    if mode == "mosaic":
+        path = f"{prefix}.png"
+        save_mosaic(segments, path, None, downsample, only_boundaries)
+    elif mode == "subviews":
+        path = prefix
+        save_subviews(segments, path, None, downsample, only_boundaries)
+    elif mode == "video":
+        path = f"{prefix}.mp4"
+        save_video(segments, path, None, downsample, only_boundaries)
+    else:
+        raise ValueError(
+            f"{mode} is not a valid mode, options: [mosaic, subviews, video]"
+        )
+    return path
+
+
+def render_experiment(
+    folder, mode="mosaic", downsample=1, only_boundaries=False, n_workers=4
+):
+    """
+    Render previews of every *_segments.pt in an experiment folder in parallel
+    returns: list of output paths
+    """
+    segments_paths = sorted(
+        f"{folder}/{filename}"
+        for filename in os.listdir(folder)
+        if filename.endswith("_segments.pt")
+    )
+    with ProcessPoolExecutor(n_workers) as executor:
+        futures = [
+            executor.submit(
+                render_segments_file, path, mode, downsample, only_boundaries
+            )
+            for path in segments_paths
+        ]
+        paths = []
+        for future in futures:
+            paths.append(future.result())
+            print(f"rendered {paths[-1]}")
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", type=str)
+    parser.add_argument("--mode", type=str, default="mosaic")  # mosaic, subviews, video
+    parser.add_argument("--downsample", type=int, default=1)
+    parser.add_argument("--only-boundaries", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    render_experiment(
+        args.folder, args.mode, args.downsample, args.only_boundaries, args.workers
+    )
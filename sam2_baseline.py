@@ -1,43 +1,67 @@
 from sam2_functions import (
+    SAM2_CONFIG,
     get_auto_mask_predictor,
     generate_image_masks,
     get_video_predictor,
     get_sam_1_auto_mask_predictor,
 )
-from data import UrbanLFSynDataset, HCIOldDataset
 import warnings
 from utils import (
     visualize_segmentation_mask,
-    masks_iou,
     save_LF_lawnmower,
+    save_LF_frames,
     lawnmower_indices,
+    center_out_indices,
     masks_to_segments,
+    remap_labels,
 )
+from timings import make_timing_record, append_timing_record, get_scene_name
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import yaml
 import os
-import matplotlib.pyplot as plt
-import numpy as np
-from plenpy.lightfields import LightField
+import math
 
 warnings.filterwarnings("ignore")
 with open("sam2_baseline_LF_segmentation.yaml") as f:
     CONFIG = yaml.load(f, Loader=yaml.FullLoader)
 
 
-def track_masks(LF, start_masks, video_predictor):
+def track_masks(
+    LF,
+    start_masks,
+    video_predictor,
+    order_indices=None,
+    frames_folder=CONFIG["lf-subview-folder"],
+    result=None,
+    stats=None,
+):
+    """
+    Propagate start masks through subviews saved in frames_folder. With
+    dynamic-pruning, objects at most prune-min-area for prune-patience frames
+    are removed from the tracking state, checked every prune-window frames
+    order_indices: list of [i, j], subview of each frame, lawnmower by default
+    result: torch.tensor [n, s, t, u, v] (torch.bool), filled in place if given
+    stats: dict, n_propagations (object-frame passes) and n_object_frames
+           (passes without pruning) are added to it if given
+    returns: torch.tensor [n, s, t, u, v] (torch.bool)
+    """
     s, t, u, v = LF.shape[:4]
-    order_indices = lawnmower_indices(s, t)
+    if order_indices is None:
+        order_indices = lawnmower_indices(s, t)
     n_masks = start_masks.shape[0]
-    result = torch.zeros((n_masks, s, t, u, v), dtype=torch.bool).cuda()
-    for mask_start_idx in range(0, n_masks, CONFIG["tracking-batch-size"]):
+    n_frames = len(order_indices)
+    if result is None:
+        result = torch.zeros((n_masks, s, t, u, v), dtype=torch.bool).cuda()
+    batch_size = CONFIG["tracking-batch-size"]
+    window = CONFIG["prune-window"] if CONFIG["dynamic-pruning"] else n_frames
+    n_propagations = 0
+    for mask_start_idx in range(0, n_masks, batch_size):
         with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-            state = video_predictor.init_state(CONFIG["lf-subview-folder"])
+            state = video_predictor.init_state(frames_folder)
             for obj_id, mask in enumerate(
-                start_masks[
-                    mask_start_idx : mask_start_idx + CONFIG["tracking-batch-size"]
-                ]
+                start_masks[mask_start_idx : mask_start_idx + batch_size]
             ):
                 video_predictor.add_new_mask(
                     state,
@@ -45,26 +69,110 @@ def track_masks(LF, start_masks, video_predictor):
                     obj_id=obj_id,
                     mask=mask,
                 )
-            for (
-                frame_idx,
-                _,
-                out_mask_logits,
-            ) in video_predictor.propagate_in_video(state):
-                masks_result = out_mask_logits[:, 0, :, :] > 0.0
-                result[
-                    mask_start_idx : mask_start_idx + CONFIG["tracking-batch-size"],
-                    order_indices[frame_idx][0],
-                    order_indices[frame_idx][1],
-                ] = masks_result
+            small_frames = {}  # obj_id -> consecutive frames below prune-min-area
+            frame_start = 0
+            # objects can't be removed while propagate_in_video is running,
+            # so frames are propagated in windows and pruned in between
+            while frame_start < n_frames and len(state["obj_ids"]) > 0:
+                for (
+                    frame_idx,
+                    obj_ids,
+                    out_mask_logits,
+                ) in video_predictor.propagate_in_video(
+                    state,
+                    start_frame_idx=frame_start,
+                    max_frame_num_to_track=window - 1,
+                ):
+                    masks_result = out_mask_logits[:, 0, :, :] > 0.0
+                    result[
+                        mask_start_idx + torch.tensor(obj_ids, device=result.device),
+                        order_indices[frame_idx][0],
+                        order_indices[frame_idx][1],
+                    ] = masks_result
+                    n_propagations += len(obj_ids)
+                    if CONFIG["dynamic-pruning"]:
+                        areas = masks_result.sum(dim=(1, 2)).tolist()
+                        for obj_id, area in zip(obj_ids, areas):
+                            small = area <= CONFIG["prune-min-area"]
+                            small_frames[obj_id] = (
+                                small_frames.get(obj_id, 0) + 1 if small else 0
+                            )
+                frame_start += window
+                for obj_id in list(small_frames):
+                    if small_frames[obj_id] >= CONFIG["prune-patience"]:
+                        video_predictor.remove_object(
+                            state, obj_id, need_output=False
+                        )
+                        del small_frames[obj_id]
             video_predictor.reset_state(state)
+    if stats is not None:
+        stats["n_propagations"] = stats.get("n_propagations", 0) + n_propagations
+        stats["n_object_frames"] = stats.get("n_object_frames", 0) + n_masks * n_frames
+    return result
+
+
+def track_masks_center_out(LF, start_masks, video_predictor, stats=None):
+    """
+    Propagate central subview masks along four quadrant paths concurrently
+    start_masks: torch.tensor [n, u, v] (torch.bool), masks of the central subview
+    stats: dict, track_masks stats summed over paths are added to it if given
+    returns: torch.tensor [n, s, t, u, v] (torch.bool)
+    """
+    s, t, u, v = LF.shape[:4]
+    result = torch.zeros((start_masks.shape[0], s, t, u, v), dtype=torch.bool).cuda()
+    paths = [path for path in center_out_indices(s, t) if len(path) > 1]
+    path_stats = [{} for _ in paths]
+    for path_i, path in enumerate(paths):
+        save_LF_frames(LF, f"{CONFIG['lf-subview-folder']}/path_{path_i}", path)
+    with ThreadPoolExecutor(max_workers=CONFIG["tracking-threads"]) as executor:
+        futures = [
+            executor.submit(
+                track_masks,
+                LF,
+                start_masks,
+                video_predictor,
+                path,
+                f"{CONFIG['lf-subview-folder']}/path_{path_i}",
+                result,  # paths only share the central subview, written identically
+                path_stats[path_i],
+            )
+            for path_i, path in enumerate(paths)
+        ]
+        for future in futures:
+            future.result()
+    if stats is not None:
+        for key in ["n_propagations", "n_object_frames"]:
+            stats[key] = stats.get(key, 0) + sum(
+                path_stat.get(key, 0) for path_stat in path_stats
+            )
     return result
 
 
 def sam2_baseline_LF_segmentation(LF, mask_predictor, video_predictor):
-    start_masks = generate_image_masks(mask_predictor, LF[0, 0])
-    print("start masks shape: ", start_masks.shape)
-    save_LF_lawnmower(LF, CONFIG["lf-subview-folder"])
-    result = track_masks(LF, start_masks, video_predictor)
+    center_out = CONFIG["tracking-order"] == "center-out"
+    start_subview = LF[LF.shape[0] // 2, LF.shape[1] // 2] if center_out else LF[0, 0]
+    generation_stats = {}
+    start_masks = generate_image_masks(
+        mask_predictor, start_subview, stats=generation_stats
+    )
+    print(
+        "start masks shape: ",
+        start_masks.shape,
+        f"prompts: {generation_stats['n_prompts']}, "
+        f"coverage: {generation_stats['coverage']:.3f}",
+    )
+    tracking_stats = {}
+    if center_out:
+        result = track_masks_center_out(
+            LF, start_masks, video_predictor, tracking_stats
+        )
+    else:
+        save_LF_lawnmower(LF, CONFIG["lf-subview-folder"])
+        result = track_masks(LF, start_masks, video_predictor, stats=tracking_stats)
+    print(
+        f"propagations: {tracking_stats['n_propagations']} "
+        f"of {tracking_stats['n_object_frames']} object-frames"
+    )
     return result
 
 
@@ -74,12 +182,12 @@ def sam2_baseline_LF_segmentation_dataset(
     continue_progress=False,
     visualize=False,
 ):
+    video_predictor = get_video_predictor()
     mask_predictor = (
-        get_auto_mask_predictor()
+        get_auto_mask_predictor(video_predictor)  # shares the video predictor weights
         if CONFIG["sam-version"] == 2
         else get_sam_1_auto_mask_predictor()
     )
-    video_predictor = get_video_predictor()
     time_path = f"{save_folder}/computation_times.pt"
     computation_times = []
     if continue_progress and os.path.exists(time_path):
@@ -98,13 +206,19 @@ def sam2_baseline_LF_segmentation_dataset(
             LF, mask_predictor, video_predictor
         )
         end_time = time()
+        n_mask_subviews = math.prod(result_masks.shape[:3])
         computation_times.append(
-            (end_time - start_time)
-            / float(
-                result_masks.shape[0] * result_masks.shape[1] * result_masks.shape[2]
-            )
+            (end_time - start_time) / float(n_mask_subviews)
+            if n_mask_subviews > 0
+            else float("nan")  # no start masks
         )
         result_segments = masks_to_segments(result_masks)
+        if CONFIG["postprocess-components"]:
+            result_segments = remap_labels(
+                result_segments,
+                CONFIG["component-connectivity"],
+                CONFIG["component-min-avg-area"],
+            )
         if visualize:
             visualize_segmentation_mask(result_segments.cpu().numpy(), LF)
         torch.save(result_masks, masks_path)
@@ -113,10 +227,21 @@ def sam2_baseline_LF_segmentation_dataset(
             torch.tensor(computation_times),
             time_path,
         )
+        append_timing_record(
+            save_folder,
+            make_timing_record(
+                get_scene_name(dataset, i),
+                {"segment": end_time - start_time},
+                {"method": CONFIG, "sam2": SAM2_CONFIG},
+                "baseline",
+            ),
+        )
         del result_masks
         del result_segments
 
 
 if __name__ == "__main__":
+    from data import UrbanLFSynDataset
+
     dataset = UrbanLFSynDataset("UrbanLF_Syn/val")
     sam2_baseline_LF_segmentation_dataset(dataset, "test_result", visualize=True)
@@ -2,30 +2,187 @@ from sam2.build_sam import build_sam2_video_predictor, build_sam2
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator, SAM2ImagePredictor
 import torch
 import yaml
-from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+import os
+import numpy as np
+import torch.nn.functional as F
+from PIL import Image
+from skimage.segmentation import slic
+from torchvision.ops import masks_to_boxes
 
 with open("sam2_config.yaml") as f:
     SAM2_CONFIG = yaml.load(f, Loader=yaml.FullLoader)
+DEVICE = SAM2_CONFIG["device"]
 
 
-def get_sam2_image_model():
-    return build_sam2(
+def quantize_sam2_model(sam2_model, modules=SAM2_CONFIG["quantize-modules"]):
+    """
+    int8 dynamic quantization of the Linear layers of the given submodules:
+    weights are stored in int8, activations are quantized on the fly (CPU only)
+    sam2_model: SAM2Base
+    modules: list of str, e.g. ["image_encoder", "sam_mask_decoder"]
+    returns: SAM2Base
+    """
+    for name in modules:
+        quantized = torch.ao.quantization.quantize_dynamic(
+            getattr(sam2_model, name), {torch.nn.Linear}, dtype=torch.qint8
+        )
+        setattr(sam2_model, name, quantized)
+    return sam2_model
+
+
+def get_exported_paths(checkpoint=SAM2_CONFIG["sam-checkpoint"]):
+    """
+    Ahead-of-time artifacts written by export.py next to the checkpoint
+    returns: dict, artifact name -> path
+    """
+    prefix = os.path.splitext(checkpoint)[0]
+    return {
+        "image_encoder": f"{prefix}.image_encoder.{DEVICE}.ts",
+        "mask_decoder": f"{prefix}.mask_decoder.{DEVICE}.ts",
+        "state_dict": f"{prefix}.exported.pt",
+    }
+
+
+def use_exported(quantization=SAM2_CONFIG["quantization"]):
+    return (
+        SAM2_CONFIG["use-exported"]
+        and quantization == "none"
+        and all(os.path.exists(path) for path in get_exported_paths().values())
+    )
+
+
+class ExportedImageEncoder(torch.nn.Module):
+    """
+    Traced image encoder with the output structure of sam2's ImageEncoder.
+    It was traced on single images, batches run image by image
+    """
+
+    def __init__(self, traced):
+        super().__init__()
+        self.traced = traced
+
+    def forward(self, sample):
+        outputs = [self.traced(sample[i : i + 1]) for i in range(sample.shape[0])]
+        outputs = [torch.cat(output) for output in zip(*outputs)]
+        n_levels = (len(outputs) - 1) // 2
+        return {
+            "vision_features": outputs[0],
+            "vision_pos_enc": outputs[1 : 1 + n_levels],
+            "backbone_fpn": outputs[1 + n_levels :],
+        }
+
+
+class ExportedMaskDecoder(torch.nn.Module):
+    """
+    Runs the traced mask decoder for calls like the one it was traced with
+    (SAM2ImagePredictor.predict with a point and a box) and the eager decoder
+    for any other call. Attributes such as conv_s0 come from the eager decoder
+    """
+
+    def __init__(self, decoder, traced, sparse_shape, multimask_output):
+        super().__init__()
+        self.decoder = decoder
+        self.traced = traced
+        self.sparse_shape = tuple(sparse_shape)
+        self.multimask_output = multimask_output
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(super().__getattr__("decoder"), name)
+
+    def forward(
+        self,
+        image_embeddings,
+        image_pe,
+        sparse_prompt_embeddings,
+        dense_prompt_embeddings,
+        multimask_output,
+        repeat_image,
+        high_res_features=None,
+    ):
+        if (
+            tuple(sparse_prompt_embeddings.shape) == self.sparse_shape
+            and multimask_output == self.multimask_output
+            and not repeat_image
+            and high_res_features is not None
+            and image_embeddings.shape[0] == 1
+        ):
+            return self.traced(
+                image_embeddings,
+                image_pe,
+                sparse_prompt_embeddings,
+                dense_prompt_embeddings,
+                *high_res_features,
+            )
+        return self.decoder(
+            image_embeddings,
+            image_pe,
+            sparse_prompt_embeddings,
+            dense_prompt_embeddings,
+            multimask_output,
+            repeat_image,
+            high_res_features,
+        )
+
+
+def load_exported(sam2_model):
+    """
+    Swap the image encoder and mask decoder of a weightless sam2_model for the
+    exported ones and load the remaining weights
+    sam2_model: SAM2Base built without a checkpoint
+    returns: SAM2Base
+    """
+    paths = get_exported_paths()
+    exported = torch.load(paths["state_dict"], map_location=DEVICE)
+    sam2_model.load_state_dict(exported["state_dict"], strict=False)
+    sam2_model.image_encoder = ExportedImageEncoder(
+        torch.jit.load(paths["image_encoder"], map_location=DEVICE)
+    )
+    sam2_model.sam_mask_decoder = ExportedMaskDecoder(
+        sam2_model.sam_mask_decoder,
+        torch.jit.load(paths["mask_decoder"], map_location=DEVICE),
+        exported["decoder-sparse-shape"],
+        exported["decoder-multimask-output"],
+    )
+    return sam2_model
+
+
+def get_sam2_image_model(quantization=SAM2_CONFIG["quantization"]):
+    """
+    quantization: str, [none, int8]
+    """
+    exported = use_exported(quantization)
+    sam2_img_model = build_sam2(
         SAM2_CONFIG["sam-config"],
-        SAM2_CONFIG["sam-checkpoint"],
-        device="cuda",
+        None if exported else SAM2_CONFIG["sam-checkpoint"],
+        device=DEVICE,
         apply_postprocessing=False,
     )
+    if exported:
+        sam2_img_model = load_exported(sam2_img_model)
+    if quantization == "int8":
+        if DEVICE != "cpu":
+            raise ValueError("int8 quantized layers run on CPU only, set device: cpu")
+        sam2_img_model = quantize_sam2_model(sam2_img_model)
+    elif quantization != "none":
+        raise ValueError(f"{quantization} is not a valid quantization")
+    return sam2_img_model
 
 
 def get_image_predictor(sam2_img_model=None):
-    if not sam2_img_model:
+    if sam2_img_model is None:
         sam2_img_model = get_sam2_image_model()
     predictor = SAM2ImagePredictor(sam2_img_model)
     return predictor
 
 
 def get_auto_mask_predictor(sam2_img_model=None):
-    if not sam2_img_model:
+    """
+    sam2_img_model: SAM2Base, e.g. the video predictor to share its weights
+    """
+    if sam2_img_model is None:
         sam2_img_model = get_sam2_image_model()
     predictor = SAM2AutomaticMaskGenerator(
         sam2_img_model,
@@ -41,8 +198,10 @@ def get_auto_mask_predictor(sam2_img_model=None):
 
 
 def get_sam_1_auto_mask_predictor():
+    from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+
     sam = sam_model_registry["vit_h"](checkpoint="SAM_model/sam_vit_h.pth")
-    sam = sam.to(device="cuda")
+    sam = sam.to(device=DEVICE)
     predictor = SamAutomaticMaskGenerator(
         sam,
         points_per_side=SAM2_CONFIG["points-per-side"],
@@ -57,9 +216,14 @@ def get_sam_1_auto_mask_predictor():
 
 
 def get_video_predictor():
+    exported = use_exported()
     predictor = build_sam2_video_predictor(
-        SAM2_CONFIG["sam-config"], SAM2_CONFIG["sam-checkpoint"]
+        SAM2_CONFIG["sam-config"],
+        None if exported else SAM2_CONFIG["sam-checkpoint"],
+        device=DEVICE,
     )
+    if exported:
+        predictor = load_exported(predictor)
     return predictor
 
 
@@ -76,9 +240,162 @@ def get_image_masks_from_boxes(image_predictor, boxes, image):
     return masks
 
 
-def generate_image_masks(auto_mask_predictor, image):
-    result = auto_mask_predictor.generate(image)
-    result = torch.stack([torch.tensor(x["segmentation"]).cuda() for x in result])
+def get_adaptive_point_grid(
+    image,
+    disparities=None,
+    n_segments=SAM2_CONFIG["adaptive-n-segments"],
+    n_edge_points=SAM2_CONFIG["adaptive-n-edge-points"],
+    disparity_edge_thresh=SAM2_CONFIG["adaptive-disp-edge-thresh"],
+):
+    """
+    Place point prompts at superpixel centers and on both sides of disparity edges
+    image: np.array [u, v, 3] (np.uint8)
+    disparities: np.array [u, v] (np.float32)
+    returns: np.array [k, 2] (np.float), (x, y) normalized to [0, 1]
+    """
+    u, v = image.shape[:2]
+    features = image.astype(np.float32) / 255.0
+    if disparities is not None:
+        disparities = np.nan_to_num(disparities)
+        disparities_normalized = (disparities - disparities.min()) / (
+            disparities.max() - disparities.min() + 1e-9
+        )
+        features = np.concatenate(
+            [features, disparities_normalized[..., None]], axis=-1
+        )
+    superpixels = slic(
+        features,
+        n_segments=n_segments,
+        compactness=0.1,
+        channel_axis=-1,
+        convert2lab=False,
+        start_label=0,
+    ).reshape(-1)
+    uu, vv = np.indices((u, v)).reshape(2, -1)
+    counts = np.bincount(superpixels)
+    centroid_u = np.bincount(superpixels, uu)[superpixels] / counts[superpixels]
+    centroid_v = np.bincount(superpixels, vv)[superpixels] / counts[superpixels]
+    distances = (uu - centroid_u) ** 2 + (vv - centroid_v) ** 2
+    order = np.lexsort((distances, superpixels))
+    first = np.r_[True, superpixels[order][1:] != superpixels[order][:-1]]
+    points = [np.stack([uu[order][first], vv[order][first]], axis=1)]
+    if disparities is not None and n_edge_points > 0:
+        grad_u, grad_v = np.gradient(disparities)
+        magnitude = np.sqrt(grad_u**2 + grad_v**2)
+        edge_uv = np.argwhere(magnitude > disparity_edge_thresh)
+        if edge_uv.shape[0] > 0:
+            cell = max(int(np.sqrt(u * v / n_edge_points)), 1)
+            _, cell_first = np.unique(
+                (edge_uv[:, 0] // cell) * (v // cell + 1) + edge_uv[:, 1] // cell,
+                return_index=True,
+            )
+            edge_uv = edge_uv[cell_first]
+            direction = np.stack(
+                [
+                    grad_u[edge_uv[:, 0], edge_uv[:, 1]],
+                    grad_v[edge_uv[:, 0], edge_uv[:, 1]],
+                ],
+                axis=1,
+            )
+            direction /= np.linalg.norm(direction, axis=1, keepdims=True) + 1e-9
+            offset = np.round(direction * cell / 4)
+            points += [edge_uv + offset, edge_uv - offset]
+    points = np.concatenate(points).astype(np.float64)
+    points[:, 0] = np.clip(points[:, 0], 0, u - 1)
+    points[:, 1] = np.clip(points[:, 1], 0, v - 1)
+    points = np.unique(points, axis=0)
+    return np.stack([(points[:, 1] + 0.5) / v, (points[:, 0] + 0.5) / u], axis=1)
+
+
+def refine_upsampled_masks(
+    auto_mask_predictor, image, masks, batch_size=SAM2_CONFIG["points-per-batch"]
+):
+    """
+    Decode masks found on a downscaled image again at full resolution, prompted
+    with their upscaled boxes. Masks the decoder loses keep their upsampled shape
+    image: np.array [u, v, 3] (np.uint8)
+    masks: torch.tensor [n, u, v] (torch.bool), upsampled masks
+    returns: torch.tensor [n, u, v] (torch.bool)
+    """
+    if not isinstance(auto_mask_predictor, SAM2AutomaticMaskGenerator):
+        raise ValueError("generation-downscale needs the SAM 2 mask generator")
+    predictor = auto_mask_predictor.predictor
+    predictor.set_image(image)
+    boxes = masks_to_boxes(masks).cpu().numpy()
+    result = []
+    for i in range(0, masks.shape[0], batch_size):
+        refined, _, _ = predictor.predict(
+            box=boxes[i : i + batch_size], multimask_output=False
+        )
+        refined = torch.tensor(refined, device=DEVICE).bool().reshape(
+            -1, *image.shape[:2]
+        )
+        lost = refined.sum(dim=(1, 2)) == 0
+        refined[lost] = masks[i : i + batch_size][lost]
+        result.append(refined)
+    predictor.reset_predictor()
+    return torch.cat(result)
+
+
+def generate_image_masks(
+    auto_mask_predictor,
+    image,
+    disparities=None,
+    stats=None,
+    point_grid=None,
+    downscale=SAM2_CONFIG["generation-downscale"],
+):
+    """
+    Run automatic mask generation on an image
+    image: np.array [u, v, 3] (np.uint8)
+    disparities: np.array [u, v] (np.float32), used by the adaptive prompt sampler
+    stats: dict, filled with the number of point prompts and mask coverage
+    point_grid: np.array [k, 2] (np.float), (x, y) in [0, 1], overrides the sampler
+    downscale: int, generate and deduplicate candidates on an image downscaled by
+               this factor, then decode only the surviving masks at full resolution
+    returns: torch.tensor [n, u, v] (torch.bool)
+    """
+    u, v = image.shape[:2]
+    full_image = image
+    if downscale > 1:
+        image = np.array(
+            Image.fromarray(image).resize(
+                (v // downscale, u // downscale), Image.BILINEAR
+            )
+        )
+        if disparities is not None:
+            disparities = disparities[::downscale, ::downscale][
+                : image.shape[0], : image.shape[1]
+            ]
+    default_point_grids = auto_mask_predictor.point_grids
+    if point_grid is not None:
+        auto_mask_predictor.point_grids = [point_grid]
+    elif SAM2_CONFIG["prompt-sampler"] == "adaptive":
+        auto_mask_predictor.point_grids = [
+            get_adaptive_point_grid(image, disparities)
+        ]
+    elif SAM2_CONFIG["prompt-sampler"] != "grid":
+        raise ValueError(
+            f"{SAM2_CONFIG['prompt-sampler']} is not a valid prompt sampler"
+        )
+    try:
+        result = auto_mask_predictor.generate(image)
+    finally:
+        n_prompts = auto_mask_predictor.point_grids[0].shape[0]
+        auto_mask_predictor.point_grids = default_point_grids
+    result = [torch.tensor(x["segmentation"]).to(DEVICE) for x in result]
+    if len(result) == 0:
+        result = torch.zeros((0, u, v), dtype=torch.bool).to(DEVICE)
+    else:
+        result = torch.stack(result)
+    if downscale > 1 and result.shape[0] > 0:
+        result = F.interpolate(result[:, None].float(), (u, v), mode="nearest")
+        result = refine_upsampled_masks(
+            auto_mask_predictor, full_image, result[:, 0].bool()
+        )
+    if stats is not None:
+        stats["n_prompts"] = n_prompts
+        stats["coverage"] = result.any(dim=0).float().mean().item()
     return result
 
 
@@ -0,0 +1,242 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from queue import Queue, Empty, Full
+from time import time
+import argparse
+import io
+import json
+import numpy as np
+import torch
+import yaml
+from sam2_functions import get_auto_mask_predictor, get_sam_1_auto_mask_predictor
+from ours import (
+    CONFIG as OURS_CONFIG,
+    sam_fast_LF_segmentation,
+    get_anchor_subviews,
+    get_subview_embeddings_batch,
+)
+from utils import masks_to_segments
+
+with open("server_config.yaml") as f:
+    SERVER_CONFIG = yaml.load(f, Loader=yaml.FullLoader)
+
+
+class SegmentationJob:
+    def __init__(self, LF, return_masks=False):
+        self.LF = LF
+        self.return_masks = return_masks
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.submitted = time()
+
+
+class SegmentationWorker:
+    """
+    Keeps the models resident and runs queued light fields on a single thread.
+    Requests waiting in the queue together share batched encoder calls.
+    """
+
+    def __init__(self):
+        self.queue = Queue(maxsize=SERVER_CONFIG["max-queue"])
+        self.lock = Lock()
+        self.metrics = {
+            "requests_total": 0,
+            "requests_failed": 0,
+            "requests_rejected": 0,
+            "batches_total": 0,
+            "latency_s_total": 0.0,
+            "inference_s_total": 0.0,
+            "last_latency_s": None,
+        }
+        self.start_time = time()
+        self.ready = False
+        self.mask_predictor = None
+
+    def load(self):
+        self.mask_predictor = (
+            get_auto_mask_predictor()
+            if OURS_CONFIG["sam-version"] == 2
+            else get_sam_1_auto_mask_predictor()
+        )
+        self.mask_predictor.predictor.set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+        self.ready = True
+
+    def submit(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            with self.lock:
+                self.metrics["requests_rejected"] += 1
+            return False
+        return True
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < SERVER_CONFIG["max-batch"]:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run_batch(self, batch):
+        subview_embeddings = [None] * len(batch)
+        if OURS_CONFIG["use-semantic"]:
+            subview_embeddings = get_subview_embeddings_batch(
+                self.mask_predictor.predictor,
+                [job.LF for job in batch],
+                [get_anchor_subviews(*job.LF.shape[:2]) for job in batch],
+                SERVER_CONFIG["encoder-batch-size"],
+            )
+        for i, job in enumerate(batch):
+            start_time = time()
+            try:
+                masks = sam_fast_LF_segmentation(
+                    self.mask_predictor,
+                    job.LF,
+                    subview_embeddings=subview_embeddings[i],
+                )
+                subview_embeddings[i] = None
+                job.result = encode_result(masks, job.return_masks)
+                del masks
+            except Exception as e:
+                job.error = repr(e)
+                torch.cuda.empty_cache()
+            end_time = time()
+            with self.lock:
+                self.metrics["requests_total"] += 1
+                self.metrics["requests_failed"] += job.error is not None
+                self.metrics["inference_s_total"] += end_time - start_time
+                self.metrics["latency_s_total"] += end_time - job.submitted
+                self.metrics["last_latency_s"] = end_time - job.submitted
+            job.done.set()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            with self.lock:
+                self.metrics["batches_total"] += 1
+            try:
+                self.run_batch(batch)
+            except Exception as e:  # batched encoder failure, fail the whole batch
+                for job in batch:
+                    if not job.done.is_set():
+                        job.error = repr(e)
+                        job.done.set()
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        n_requests = max(metrics["requests_total"], 1)
+        metrics["mean_latency_s"] = metrics["latency_s_total"] / n_requests
+        metrics["mean_inference_s"] = metrics["inference_s_total"] / n_requests
+        metrics["queue_depth"] = self.queue.qsize()
+        metrics["uptime_s"] = time() - self.start_time
+        if torch.cuda.is_available():
+            metrics["gpu_memory_mb"] = torch.cuda.memory_allocated() / 2**20
+        return metrics
+
+
+def encode_result(masks, return_masks=False):
+    """
+    Pack segmentation into a compressed npz
+    masks: torch.tensor [n, s, t, u, v] (torch.bool)
+    returns: bytes, "segments" [s, t, u, v] (np.uint16) and optionally
+             "masks" bit-packed with their shape in "masks_shape"
+    """
+    segments = masks_to_segments(masks).cpu().numpy().astype(np.uint16)
+    arrays = {"segments": segments}
+    if return_masks:
+        masks = masks.cpu().numpy()
+        arrays["masks"] = np.packbits(masks.reshape(-1))
+        arrays["masks_shape"] = np.array(masks.shape)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def decode_light_field(body, content_type):
+    """
+    Read a light field from a raw .npy body or a json {"path": ...} to a .npy file
+    returns: np.array [s, t, u, v, 3] (np.uint8)
+    """
+    if content_type == "application/json":
+        LF = np.load(json.loads(body)["path"])
+    else:
+        LF = np.load(io.BytesIO(body))
+    if LF.ndim != 5 or LF.shape[-1] < 3:
+        raise ValueError(f"expected [s, t, u, v, 3] light field, got {LF.shape}")
+    return np.ascontiguousarray(LF[..., :3]).astype(np.uint8)
+
+
+def make_handler(worker):
+    class SegmentationHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(
+                    200 if worker.ready else 503,
+                    {"status": "ok" if worker.ready else "loading"},
+                )
+            elif self.path == "/metrics":
+                self.send_json(200, worker.get_metrics())
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if not self.path.startswith("/segment"):
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                LF = decode_light_field(body, self.headers.get("Content-Type"))
+            except Exception as e:
+                self.send_json(400, {"error": repr(e)})
+                return
+            job = SegmentationJob(LF, return_masks="masks=1" in self.path)
+            if not worker.submit(job):
+                self.send_json(503, {"error": "queue is full"})
+                return
+            job.done.wait()
+            if job.error is not None:
+                self.send_json(500, {"error": job.error})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(job.result)))
+            self.end_headers()
+            self.wfile.write(job.result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SegmentationHandler
+
+
+def serve(host=SERVER_CONFIG["host"], port=SERVER_CONFIG["port"]):
+    worker = SegmentationWorker()
+    server = ThreadingHTTPServer((host, port), make_handler(worker))
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"loading models, health at http://{host}:{port}/health")
+    worker.load()
+    print("models loaded, serving POST /segment, GET /health, GET /metrics")
+    try:
+        worker.run()
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=SERVER_CONFIG["host"])
+    parser.add_argument("--port", type=int, default=SERVER_CONFIG["port"])
+    args = parser.parse_args()
+    serve(args.host, args.port)
@@ -0,0 +1,272 @@
+from time import time
+import argparse
+import itertools
+import os
+import pandas as pd
+import torch
+import yaml
+from registry import NAME_TO_DATASET, load_registered
+from sam2_functions import (
+    DEVICE,
+    get_auto_mask_predictor,
+    get_sam_1_auto_mask_predictor,
+    generate_image_masks,
+)
+from ours import (
+    CONFIG,
+    get_pruned_masks,
+    get_mask_disparities,
+    get_anchor_subviews,
+    get_nearest_anchor,
+    get_subview_embeddings,
+    get_coarse_matching,
+    refine_coarse_masks_semantic,
+    get_prompts_for_masks,
+    decode_subview,
+    warp_anchor_masks,
+    get_mask_chunk_size,
+    get_spill_storage,
+)
+from metrics import ConsistencyMetrics, AccuracyMetrics
+from timings import get_scene_name
+from utils import get_LF_disparities, masks_to_segments
+
+GRID_KEYS = ["iou-thresh", "sim-thresh", "use-semantic"]
+
+
+def get_prompt_groups(grid):
+    """
+    Distinct prompt computations of a grid, sim-thresh only matters with semantics
+    returns: list of (bool, float or None), (use-semantic, sim-thresh)
+    """
+    groups = []
+    for use_semantic in grid["use-semantic"]:
+        for sim_thresh in grid["sim-thresh"] if use_semantic else [None]:
+            groups.append((use_semantic, sim_thresh))
+    return groups
+
+
+def get_shared_outputs(mask_predictor, LF, grid):
+    """
+    Run every model-dependent stage once for all grid points: central masks,
+    subview embeddings, coarse matching, one image encoding per anchor subview
+    and one decoding per prompt group
+    LF: np.array [s, t, u, v, 3] (np.uint8)
+    returns: dict
+    """
+    s_size, t_size = LF.shape[:2]
+    s_central, t_central = s_size // 2, t_size // 2
+    disparities = torch.tensor(get_LF_disparities(LF)).to(DEVICE)
+    masks_central = generate_image_masks(
+        mask_predictor, LF[s_central, t_central], disparities.cpu().numpy()
+    )
+    if CONFIG["prune-masks"]:
+        masks_central = masks_central[get_pruned_masks(masks_central)]
+    mask_disparities = get_mask_disparities(masks_central, disparities)
+    mask_depth_order = torch.argsort(mask_disparities)
+    masks_central = masks_central[mask_depth_order]
+    mask_disparities = mask_disparities[mask_depth_order]
+    anchors = get_anchor_subviews(s_size, t_size)
+    groups = get_prompt_groups(grid)
+    subview_embeddings = None
+    if any(use_semantic for use_semantic, _ in groups):
+        subview_embeddings = get_subview_embeddings(
+            mask_predictor.predictor, LF, anchors
+        )
+    shape = (masks_central.shape[0], *LF.shape[:4])
+    coarse_masks = get_spill_storage(shape)
+    prompts = {group: ([], []) for group in groups}
+    chunk_size = get_mask_chunk_size(LF)
+    for chunk_start in range(0, masks_central.shape[0], chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        coarse_chunk = get_coarse_matching(
+            LF, masks_central[chunk], mask_disparities[chunk], disparities
+        )
+        coarse_masks[chunk] = coarse_chunk.cpu()
+        for use_semantic, sim_thresh in groups:
+            weighted_chunk = coarse_chunk
+            if use_semantic:
+                weighted_chunk = refine_coarse_masks_semantic(
+                    subview_embeddings, coarse_chunk, anchors, sim_thresh
+                )
+            point_prompts, box_prompts = get_prompts_for_masks(
+                weighted_chunk, anchors, use_semantic
+            )
+            prompts[(use_semantic, sim_thresh)][0].append(point_prompts)
+            prompts[(use_semantic, sim_thresh)][1].append(box_prompts)
+            del weighted_chunk
+        del coarse_chunk
+    del subview_embeddings
+    prompts = {
+        group: (torch.cat(point_prompts), torch.cat(box_prompts))
+        for group, (point_prompts, box_prompts) in prompts.items()
+    }
+    fine_masks = {group: get_spill_storage(shape) for group in groups}
+    fine_ious = {group: torch.zeros(shape[:3]).to(DEVICE) for group in groups}
+    for s in range(s_size):
+        for t in range(t_size):
+            if not anchors[s, t] or (s == s_central and t == t_central):
+                continue
+            coarse_masks_st = coarse_masks[:, s, t].to(DEVICE)
+            to_refine = {
+                group: point_prompts[:, s, t].sum(dim=1) > 1e-6
+                for group, (point_prompts, _) in prompts.items()
+            }
+            if not any(to_refine_g.any() for to_refine_g in to_refine.values()):
+                continue
+            mask_predictor.predictor.set_image(LF[s, t])
+            for group, (point_prompts, box_prompts) in prompts.items():
+                fine_masks_st, fine_ious[group][:, s, t] = decode_subview(
+                    mask_predictor.predictor,
+                    coarse_masks_st,
+                    point_prompts[:, s, t],
+                    box_prompts[:, s, t],
+                    to_refine[group],
+                )
+                fine_masks[group][:, s, t] = fine_masks_st.cpu()
+    return {
+        "anchors": anchors,
+        "mask_disparities": mask_disparities,
+        "coarse_masks": coarse_masks,
+        "fine_masks": fine_masks,
+        "fine_ious": fine_ious,
+    }
+
+
+def get_grid_point_masks(shared, group, iou_thresh, out):
+    """
+    Refined masks of one grid point from the shared outputs, as refine_subview
+    and iterate_refined_matching would produce them
+    out: torch.tensor [n, s, t, u, v] (torch.bool) on host, overwritten
+    returns: out
+    """
+    anchors = shared["anchors"]
+    s_size, t_size = anchors.shape
+    for s in range(s_size):
+        for t in range(t_size):
+            if anchors[s, t]:
+                matched = (shared["fine_ious"][group][:, s, t] > iou_thresh).cpu()
+                out[:, s, t] = shared["coarse_masks"][:, s, t]
+                out[matched, s, t] = shared["fine_masks"][group][matched, s, t]
+    for s in range(s_size):
+        for t in range(t_size):
+            if not anchors[s, t]:
+                s_anchor, t_anchor = get_nearest_anchor(anchors, s, t)
+                out[:, s, t] = warp_anchor_masks(
+                    out[:, s_anchor, t_anchor].to(DEVICE),
+                    shared["mask_disparities"],
+                    s - s_anchor,
+                    t - t_anchor,
+                ).cpu()
+    return out
+
+
+def get_grid_point_metrics(masks, labels, disparity, sweep_config, is_real=False):
+    """
+    masks: torch.tensor [n, s, t, u, v] (torch.bool)
+    returns: dict
+    """
+    metrics_dict = {"n_masks": masks.shape[0]}
+    if masks.shape[0] == 0:
+        return metrics_dict
+    masks = masks.to(DEVICE)
+    if not is_real and disparity is not None:
+        metrics_dict.update(
+            ConsistencyMetrics(
+                masks,
+                disparity,
+                approximate=sweep_config.get("approximate-metrics", False),
+                tolerance=sweep_config.get("metrics-tolerance", 0.02),
+            ).get_metrics_dict()
+        )
+    segments = masks_to_segments(masks)
+    del masks
+    if labels is not None:
+        metrics_dict.update(
+            AccuracyMetrics(
+                segments,
+                labels,
+                only_central_subview=is_real,
+                approximate=sweep_config.get("approximate-metrics", False),
+                tolerance=sweep_config.get("metrics-tolerance", 0.02),
+            ).get_metrics_dict()
+        )
+    return metrics_dict
+
+
+def sweep_scene(mask_predictor, LF, labels, disparity, sweep_config, is_real=False):
+    """
+    Evaluate every grid point on one scene
+    returns: list of dict, grid values and metrics
+    """
+    grid = sweep_config["grid"]
+    start_time = time()
+    shared = get_shared_outputs(mask_predictor, LF, grid)
+    shared_time = time() - start_time
+    masks = torch.zeros(shared["coarse_masks"].shape, dtype=torch.bool)
+    rows = []
+    for group in shared["fine_masks"]:
+        use_semantic, sim_thresh = group
+        for iou_thresh in grid["iou-thresh"]:
+            get_grid_point_masks(shared, group, iou_thresh, masks)
+            metrics_dict = get_grid_point_metrics(
+                masks, labels, disparity, sweep_config, is_real
+            )
+            sim_threshs = [sim_thresh] if use_semantic else grid["sim-thresh"]
+            for sim_thresh_i in sim_threshs:  # same masks without semantics
+                rows.append(
+                    {
+                        "iou-thresh": iou_thresh,
+                        "sim-thresh": sim_thresh_i,
+                        "use-semantic": use_semantic,
+                        "shared_time": shared_time,
+                        **metrics_dict,
+                    }
+                )
+    return rows
+
+
+def sweep(sweep_config):
+    """
+    Run the grid of sweep_config over its dataset and write one metrics table,
+    averaged over scenes, to experiments/{exp-name}/sweep_metrics.csv
+    """
+    save_folder = f"experiments/{sweep_config['exp-name']}"
+    os.makedirs(save_folder, exist_ok=True)
+    with open(f"{save_folder}/sweep_config.yaml", "w") as outfile:
+        yaml.dump(sweep_config, outfile, default_flow_style=False)
+    dataset_class, _ = load_registered(NAME_TO_DATASET, sweep_config["dataset-name"])
+    dataset = dataset_class(**sweep_config.get("dataset-args", {}))
+    is_real = sweep_config["dataset-name"] == "URBAN_REAL"
+    mask_predictor = (
+        get_auto_mask_predictor()
+        if CONFIG["sam-version"] == 2
+        else get_sam_1_auto_mask_predictor()
+    )
+    n_points = len(list(itertools.product(*sweep_config["grid"].values())))
+    rows = []
+    for i in range(len(dataset)):
+        item = dataset[i]
+        LF, labels = item[0], item[1]
+        disparity = item[2] if len(item) > 2 else None
+        print(f"sweeping lf {i} over {n_points} grid points")
+        for row in sweep_scene(
+            mask_predictor, LF, labels, disparity, sweep_config, is_real
+        ):
+            rows.append({"scene": get_scene_name(dataset, i), **row})
+        pd.DataFrame(rows).to_csv(f"{save_folder}/sweep_scene_metrics.csv")
+        torch.cuda.empty_cache()
+    metrics_dataframe = (
+        pd.DataFrame(rows).drop(columns="scene").groupby(GRID_KEYS).mean()
+    )
+    metrics_dataframe.to_csv(f"{save_folder}/sweep_metrics.csv")
+    print(metrics_dataframe)
+    return metrics_dataframe
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", type=str, nargs="?", default="sweep_config.yaml")
+    args = parser.parse_args()
+    with open(args.filename) as f:
+        sweep(yaml.load(f, Loader=yaml.FullLoader))
@@ -0,0 +1,205 @@
+from time import time
+import argparse
+import hashlib
+import json
+import math
+import os
+import subprocess
+import sys
+
+TIMINGS_FILE = "timings.jsonl"
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def get_device():
+    import torch
+
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_name(0)
+    return "cpu"
+
+
+def get_scene_name(dataset, i):
+    for attribute in ["scenes", "frames"]:
+        if hasattr(dataset, attribute):
+            return str(getattr(dataset, attribute)[i])
+    return str(i).zfill(4)
+
+
+def make_timing_record(scene, stages, config, method):
+    """
+    One scene's timings with everything needed to compare it across runs
+    scene: str
+    stages: dict, stage name -> seconds, "stage.sub_stage" names break a stage
+            down and are not added to the total
+    config: dict, method and SAM2 configs
+    method: str
+    returns: dict
+    """
+    config_json = json.dumps(config, sort_keys=True, default=str)
+    return {
+        "scene": scene,
+        "method": method,
+        "stages": {name: float(seconds) for name, seconds in stages.items()},
+        "total": float(
+            sum(seconds for name, seconds in stages.items() if "." not in name)
+        ),
+        "config": json.loads(config_json),
+        "config_hash": hashlib.sha1(config_json.encode()).hexdigest()[:8],
+        "commit": get_commit(),
+        "device": get_device(),
+        "timestamp": time(),
+    }
+
+
+def append_timing_record(folder, record):
+    """
+    Append a record to the folder's timing history, kept across runs
+    """
+    with open(f"{folder}/{TIMINGS_FILE}", "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def load_timing_records(folder):
+    path = f"{folder}/{TIMINGS_FILE}"
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"no {TIMINGS_FILE} in {folder}")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def relative_spread(values):
+    """
+    Median absolute deviation relative to the median, 0 for a single run
+    """
+    center = median(values)
+    return median([abs(value - center) for value in values]) / max(center, 1e-9)
+
+
+def compare_times(base, new, min_noise, n_sigmas=3):
+    """
+    base, new: list of float, repeated runs of the same measurement
+    returns: (float, float), new / base median ratio and the relative change
+             under which it is considered noise
+    """
+    noise = n_sigmas * math.hypot(relative_spread(base), relative_spread(new))
+    return median(new) / max(median(base), 1e-9), max(min_noise, noise)
+
+
+def get_latest_config_records(records):
+    """
+    Records run with the config of the latest record, older configs would mix
+    different workloads into one median
+    returns: list of dict
+    """
+    if len(records) == 0:
+        return records
+    latest = max(records, key=lambda record: record["timestamp"])
+    return [
+        record for record in records if record["config_hash"] == latest["config_hash"]
+    ]
+
+
+def get_scene_times(records):
+    """
+    returns: dict, scene -> stage name (and "total") -> list of seconds over runs
+    """
+    scene_times = {}
+    for record in records:
+        times = scene_times.setdefault(record["scene"], {})
+        for name, seconds in {**record["stages"], "total": record["total"]}.items():
+            times.setdefault(name, []).append(seconds)
+    return scene_times
+
+
+def compare_folders(base_folder, new_folder, limit=0.05, min_noise=0.03):
+    """
+    Report per-scene and per-stage changes of new_folder against base_folder,
+    each folder's records are limited to its latest config
+    limit: float, max relative slowdown of a scene total or of the geometric mean
+    min_noise: float, smallest relative change that is not considered noise
+    returns: bool, True if a regression exceeds the limit
+    """
+    base_records = load_timing_records(base_folder)
+    new_records = load_timing_records(new_folder)
+    for folder, records in [(base_folder, base_records), (new_folder, new_records)]:
+        n_skipped = len(records) - len(get_latest_config_records(records))
+        if n_skipped > 0:
+            print(f"{folder}: skipping {n_skipped} records of older configs")
+    base_records = get_latest_config_records(base_records)
+    new_records = get_latest_config_records(new_records)
+    for key in ["device", "commit", "config_hash"]:
+        base_values = sorted({str(record[key]) for record in base_records})
+        new_values = sorted({str(record[key]) for record in new_records})
+        print(f"{key}: {', '.join(base_values)} -> {', '.join(new_values)}")
+    if {r["device"] for r in base_records} != {r["device"] for r in new_records}:
+        print("warning: runs were timed on different devices")
+    base_times = get_scene_times(base_records)
+    new_times = get_scene_times(new_records)
+    failed = False
+    log_ratios = []
+    for scene in sorted(set(base_times) & set(new_times)):
+        for name in base_times[scene]:
+            if name not in new_times[scene]:
+                continue
+            ratio, noise = compare_times(
+                base_times[scene][name], new_times[scene][name], min_noise
+            )
+            if ratio > 1 + noise:
+                verdict = "regression"
+            elif ratio < 1 - noise:
+                verdict = "speedup"
+            else:
+                verdict = "within noise"
+            regression = name == "total" and ratio > 1 + max(limit, noise)
+            failed |= regression
+            print(
+                f"{scene:>20} {name:>16}: "
+                f"{median(base_times[scene][name]):8.2f}s -> "
+                f"{median(new_times[scene][name]):8.2f}s "
+                f"x{1 / ratio:.2f} ({verdict}, noise {noise:.1%})"
+                + (" FAILED" if regression else "")
+            )
+            if name == "total":
+                log_ratios.append(math.log(ratio))
+    if len(log_ratios) == 0:
+        print("no common scenes to compare")
+        return False
+    mean_ratio = math.exp(sum(log_ratios) / len(log_ratios))
+    print(f"mean speedup over {len(log_ratios)} scenes: x{1 / mean_ratio:.3f}")
+    if mean_ratio > 1 + limit:
+        failed = True
+        print(f"FAILED: mean slowdown {mean_ratio - 1:.1%} exceeds {limit:.1%}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base_folder", type=str)
+    parser.add_argument("new_folder", type=str)
+    parser.add_argument("--limit", type=float, default=0.05)
+    parser.add_argument("--min-noise", type=float, default=0.03)
+    args = parser.parse_args()
+    failed = compare_folders(
+        args.base_folder, args.new_folder, args.limit, args.min_noise
+    )
+    sys.exit(int(failed))
@@ -1,15 +1,13 @@
 import numpy as np
 import imgviz
 from PIL import Image
-import yaml
 import torch
 from scipy.io import savemat
 from plenpy.lightfields import LightField
 import logging
-from scipy import ndimage
 from skimage.segmentation import mark_boundaries
 import os
-from plenpy.lightfields import LightField
+import itertools
 
 logging.getLogger("plenpy").setLevel(logging.WARNING)
 
@@ -30,10 +28,21 @@ def predict_mask_subview_position(mask, disparities, s, t):
     s, t: float
     returns: torch.tensor [u, v] (torch.bool)
     """
-    st = torch.tensor([s, t]).float().cuda()
-    uv_0 = torch.nonzero(mask)
     disparities_uv = disparities[mask].reshape(-1)
-    uv = (uv_0 - disparities_uv.mean() * st).long()
+    return shift_mask(mask, disparities_uv.mean(), s, t)
+
+
+def shift_mask(mask, disparity, s, t):
+    """
+    Shift mask by its disparity along angular offset (s, t)
+    mask: torch.tensor [u, v] (torch.bool)
+    disparity: float
+    s, t: float
+    returns: torch.tensor [u, v] (torch.bool)
+    """
+    st = torch.tensor([s, t]).float().to(mask.device)
+    uv_0 = torch.nonzero(mask)
+    uv = (uv_0 - disparity * st).long()
     u = uv[:, 0]
     v = uv[:, 1]
     uv = uv[(u >= 0) & (v >= 0) & (u < mask.shape[0]) & (v < mask.shape[1])]
@@ -52,12 +61,52 @@ def masks_to_segments(masks):
     """
     s, t, u, v = masks.shape[1:]
     areas = masks[:, s // 2, t // 2].cpu().sum(dim=(1, 2))
-    masks_result = torch.zeros((s, t, u, v), dtype=torch.long).cuda()
+    masks_result = torch.zeros((s, t, u, v), dtype=torch.long).to(masks.device)
     for i, mask_i in enumerate(torch.argsort(areas, descending=True)):
         masks_result[masks[mask_i]] = i  # smaller segments on top of bigger ones
     return masks_result
 
 
+def get_segment_order(masks_central):
+    """
+    Segment drawing order for masks_to_segments, biggest central mask first
+    masks_central: torch.tensor [n, u, v] (torch.bool)
+    returns: torch.tensor [n] (torch.long)
+    """
+    areas = masks_central.cpu().sum(dim=(1, 2))
+    return torch.argsort(areas, descending=True)
+
+
+def subview_masks_to_segments(masks_st, segment_order):
+    """
+    Convert [n, u, v] masks of one subview to [u, v] segments
+    masks_st: torch.tensor [n, u, v] (torch.bool)
+    segment_order: torch.tensor [n] (torch.long), from get_segment_order
+    returns: torch.tensor [u, v] (torch.long)
+    """
+    segments_st = torch.zeros(masks_st.shape[1:], dtype=torch.long).to(masks_st.device)
+    for i, mask_i in enumerate(segment_order):
+        segments_st[masks_st[mask_i]] = i  # smaller segments on top of bigger ones
+    return segments_st
+
+
+def segment_boundaries(segments):
+    """
+    Pixels with a 4-neighbour in another segment of the same subview, on both
+    sides of every edge
+    segments: torch.tensor [..., u, v]
+    returns: torch.tensor [..., u, v] (torch.bool)
+    """
+    boundaries = torch.zeros(segments.shape, dtype=torch.bool, device=segments.device)
+    vertical = segments[..., 1:, :] != segments[..., :-1, :]
+    horizontal = segments[..., :, 1:] != segments[..., :, :-1]
+    boundaries[..., 1:, :] |= vertical
+    boundaries[..., :-1, :] |= vertical
+    boundaries[..., :, 1:] |= horizontal
+    boundaries[..., :, :-1] |= horizontal
+    return boundaries
+
+
 def get_LF_disparities(LF):
     """
     Get disparities for subview [s//2, t//2]
@@ -121,20 +170,91 @@ def visualize_segments(segments, filename):
     im.save(filename)
 
 
-def remap_labels(labels):
-    max_label = 0
-    labels_remapped = torch.zeros(labels.shape).to(torch.int32).cuda()
-    structure_4d = ndimage.generate_binary_structure(4, 4)
-    for label in torch.unique(labels):
-        img = (labels == label).to(torch.int32)
-        img = torch.tensor(ndimage.label(img.cpu().numpy(), structure_4d)[0]).cuda()
-        for unique_label in torch.unique(img)[1:]:
-            if (img == unique_label).sum(axis=(2, 3)).float().mean() >= MERGER_CONFIG[
-                "min-avg-labels-gt-merger"
-            ]:
-                labels_remapped[img == unique_label] = max_label + unique_label
-        max_label = labels_remapped.max()
-    return labels_remapped
+def _neighbour_slices(connectivity, n_dims=4):
+    """
+    Source and destination slices for half of the neighbour offsets of
+    ndimage.generate_binary_structure(n_dims, connectivity), the other half
+    being their mirror
+    """
+    result = []
+    for offset in itertools.product([-1, 0, 1], repeat=n_dims):
+        if not (0 < sum(abs(o) for o in offset) <= connectivity):
+            continue
+        if offset < (0,) * n_dims:
+            continue
+        src = tuple(slice(max(-o, 0), None if o <= 0 else -o) for o in offset)
+        dst = tuple(slice(max(o, 0), None if o >= 0 else o) for o in offset)
+        result.append((src, dst))
+    return result
+
+
+def connected_components_4d(labels, connectivity=1, background=None):
+    """
+    Connected components of all labels at once: min-index propagation between
+    neighbours with equal labels, hooking and pointer jumping (union-find style)
+    labels: torch.tensor [s, t, u, v] (torch.long)
+    connectivity: int, 1 (8 face neighbours) to 4 (all 80 neighbours)
+    background: int, label that is not split into components
+    returns: torch.tensor [s, t, u, v] (torch.long), the smallest flat index of
+             each component, -1 for background
+    """
+    shape = labels.shape
+    parent = torch.arange(labels.numel(), device=labels.device)
+    foreground = (
+        torch.ones_like(labels, dtype=torch.bool)
+        if background is None
+        else labels != background
+    )
+    neighbour_slices = _neighbour_slices(connectivity, len(shape))
+    while True:
+        parent_4d = parent.reshape(shape)
+        candidate = parent_4d.clone()
+        for src, dst in neighbour_slices:
+            same = (labels[src] == labels[dst]) & foreground[src]
+            candidate[src] = torch.where(
+                same, torch.minimum(candidate[src], parent_4d[dst]), candidate[src]
+            )
+            candidate[dst] = torch.where(
+                same, torch.minimum(candidate[dst], parent_4d[src]), candidate[dst]
+            )
+        candidate = candidate.reshape(-1)
+        new_parent = parent.clone()
+        new_parent.scatter_reduce_(0, parent, candidate, reduce="amin")
+        new_parent = torch.minimum(new_parent, candidate)
+        while True:  # pointer jumping to the roots
+            jumped = new_parent[new_parent]
+            if torch.equal(jumped, new_parent):
+                break
+            new_parent = jumped
+        if torch.equal(new_parent, parent):
+            break
+        parent = new_parent
+    components = parent.reshape(shape)
+    components[~foreground] = -1
+    return components
+
+
+def remap_labels(labels, connectivity=1, min_avg_area=0, background=0):
+    """
+    Split every label into its 4D connected components, drop components smaller
+    than min_avg_area pixels per subview and number the rest from 1
+    labels: torch.tensor [s, t, u, v] (torch.long)
+    background: int, unsegmented label, kept as 0 and not split
+    returns: torch.tensor [s, t, u, v] (torch.long), 0 for background and
+             dropped components
+    """
+    s, t = labels.shape[:2]
+    components = connected_components_4d(labels, connectivity, background)
+    components = components.reshape(-1)
+    foreground = components >= 0
+    areas = torch.bincount(components[foreground], minlength=components.shape[0])
+    keep = foreground.clone()
+    keep[foreground] = (
+        areas[components[foreground]].float() / float(s * t) >= min_avg_area
+    )
+    labels_remapped = torch.zeros_like(components)
+    labels_remapped[keep] = torch.unique(components[keep], return_inverse=True)[1] + 1
+    return labels_remapped.reshape(labels.shape)
 
 
 def LF_lawnmower(LF):
@@ -165,11 +285,38 @@ def lawnmower_indices(s, t, reverse=False):
     return indices
 
 
-def save_LF_lawnmower(LF, folder, prev_frame_last_subview=None, reverse=False):
+def center_out_indices(s, t):
+    """
+    Split the subview grid into four quadrant paths starting at the central subview.
+    Each path walks its quadrant row by row away from the center, so consecutive
+    frames are neighbouring subviews.
+    returns: list of 4 lists of [i, j], each starting with the central subview
+    """
+    s_central, t_central = s // 2, t // 2
+    row_ranges = [
+        range(s_central, -1, -1),
+        range(s_central + 1, s),
+    ]
+    col_ranges = [
+        list(range(t_central, -1, -1)),
+        list(range(t_central + 1, t)),
+    ]
+    paths = []
+    for rows in row_ranges:
+        for cols in col_ranges:
+            path = [[s_central, t_central]]
+            for row_n, i in enumerate(rows):
+                row_cols = cols if row_n % 2 == 0 else cols[::-1]
+                path += [[i, j] for j in row_cols if [i, j] != path[0]]
+            paths.append(path)
+    return paths
+
+
+def save_LF_frames(LF, folder, indices, prev_frame_last_subview=None):
+    """
+    Save subviews at indices as consecutive jpeg frames for the video predictor
+    """
     os.makedirs(folder, exist_ok=True)
-    shape = LF.shape
-    s, t = shape[:2]
-    indices = lawnmower_indices(s, t, reverse)
     frame_n = 0
     if prev_frame_last_subview is not None:
         Image.fromarray(prev_frame_last_subview).save(
@@ -181,5 +328,11 @@ def save_LF_lawnmower(LF, folder, prev_frame_last_subview=None, reverse=False):
         frame_n += 1
 
 
+def save_LF_lawnmower(LF, folder, prev_frame_last_subview=None, reverse=False):
+    s, t = LF.shape[:2]
+    indices = lawnmower_indices(s, t, reverse)
+    save_LF_frames(LF, folder, indices, prev_frame_last_subview)
+
+
 if __name__ == "__main__":
     pass